@@ -31,12 +31,80 @@ def sigfig(x, p):
     mags = 10 ** (p - 1 - np.floor(np.log10(x_positive)))
     return np.round(x * mags) / mags
 
+def as_array(values):
+    '''
+    array view of hazard data values: ndarrays and lazy (h5py backed) arrays are returned as is,
+    nested lists (e.g. from legacy data loaded from JSON) are converted
+    '''
+    return values if hasattr(values, 'shape') else np.asarray(values)
+
+
+def to_json_compatible(obj):
+    '''
+    recursively converts numpy (and lazy) arrays and scalars in nested dicts and lists to python types
+    '''
+    if isinstance(obj, dict):
+        return {to_json_compatible(k): to_json_compatible(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [to_json_compatible(v) for v in obj]
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if hasattr(obj, '__array__'):
+        return np.asarray(obj).tolist()
+    return obj
+
+
+def save_json(data, filepath):
+    '''
+    serialise a data dictionary (e.g. from read_oq_hdf5.retrieve_data) to JSON
+    '''
+    with open(filepath, 'w') as json_file:
+        json.dump(to_json_compatible(data), json_file)
+
+
 def find_nearest(a0, a):
     "Element in nd array `a` closest to the scalar value `a0`"
     idx = np.abs(a - a0).argmin()
     return a[idx]
 
 
+def interp_rows(x, xp, fp):
+    '''
+    linear interpolation of many curves at once, the same as np.interp(x[i], xp[i], fp[i]) for every
+    curve i (including the handling of points outside xp and of repeated xp values)
+
+    :param x: array [...] broadcastable to the curve shape, e.g. a scalar or one value per curve
+    :param xp: increasing abscissa [n] shared by all curves, or [..., n] for each curve
+    :param fp: curves [..., n]
+
+    :return: array [...]
+    '''
+
+    x = np.asarray(x, dtype=float)
+    fp = np.asarray(fp, dtype=float)
+    xp = np.broadcast_to(np.asarray(xp, dtype=float), fp.shape)
+    n = xp.shape[-1]
+    # index of the last xp at or below x, as found by the binary search in np.interp
+    j = np.sum(xp <= x[..., None], axis=-1) - 1
+    j0 = np.clip(j, 0, n - 1)[..., None]
+    j1 = np.clip(j + 1, 0, n - 1)[..., None]
+    x0 = np.take_along_axis(xp, j0, axis=-1)[..., 0]
+    x1 = np.take_along_axis(xp, j1, axis=-1)[..., 0]
+    y0 = np.take_along_axis(fp, j0, axis=-1)[..., 0]
+    y1 = np.take_along_axis(fp, j1, axis=-1)[..., 0]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = (y1 - y0) / (x1 - x0)
+        y = slope * (x - x0) + y0
+        y = np.where(np.isnan(y), slope * (x - x1) + y1, y)
+        y = np.where(np.isnan(y) & (y0 == y1), y0, y)
+
+    y = np.where(x0 == x, y0, y)
+    y = np.where(j >= n - 1, fp[..., -1], y)
+    y = np.where(j < 0, fp[..., 0], y)
+    return np.where(np.isnan(x), np.nan, y)
+
+
 def period_from_imt(imt):
     if imt in ['PGA','PGD']:
         period = 0
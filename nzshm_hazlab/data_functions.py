@@ -6,6 +6,9 @@ from nzshm_common.location import CodedLocation
 import pandas as pd
 from numpy.typing import NDArray
 
+from nzshm_hazlab.base_functions import interp_rows
+from nzshm_hazlab.hazard_cube import HazardCube
+
 def rp_from_poe(poe, inv_time):
 
     return -inv_time/np.log(1-poe)
@@ -16,31 +19,98 @@ def poe_from_rp(rp, inv_time):
     return 1 - np.exp(-inv_time/rp)
 
 
+def interp_loglog_inverse(levels: NDArray, values: NDArray, apoes: NDArray, out_of_range: str = 'clamp') -> NDArray:
+    """
+    log-log inverse interpolation of many hazard curves at many annual probabilities of exceedance
+
+    :param levels: intensity levels, shape [n_levels] or broadcastable to values
+    :param values: hazard curves (apoe), shape [..., n_levels], monotonically decreasing along the last axis
+    :param apoes: target annual probabilities of exceedance, shape [n_apoes]
+    :param out_of_range: 'clamp' to return the first (last) level for targets above (below) the curve,
+        'nan' to return NaN
+
+    :return: intensities with shape [..., n_apoes]. Curves containing NaN return NaN.
+    """
+
+    if out_of_range not in ('clamp', 'nan'):
+        raise ValueError(f"out_of_range must be 'clamp' or 'nan', not {out_of_range}")
+
+    values = np.asarray(values, dtype='float64')
+    nlevels = values.shape[-1]
+    # small numerical increases would otherwise make the bracketing ambiguous
+    values = np.minimum.accumulate(values, axis=-1)
+    levels = np.broadcast_to(np.asarray(levels, dtype='float64'), values.shape)
+    targets = np.log(np.atleast_1d(np.asarray(apoes, dtype='float64')))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_vals = np.log(values)
+        log_lvls = np.log(levels)
+
+        haz = np.empty(values.shape[:-1] + targets.shape)
+        for i, target in enumerate(targets):
+            # number of levels with apoe at or above the target
+            n_above = np.sum(log_vals >= target, axis=-1)
+            k = np.clip(n_above - 1, 0, nlevels - 2)[..., None]
+            v0 = np.take_along_axis(log_vals, k, axis=-1)[..., 0]
+            v1 = np.take_along_axis(log_vals, k + 1, axis=-1)[..., 0]
+            l0 = np.take_along_axis(log_lvls, k, axis=-1)[..., 0]
+            l1 = np.take_along_axis(log_lvls, k + 1, axis=-1)[..., 0]
+            t = (target - v0) / (v1 - v0)
+            # an apoe of zero at the upper bracket gives t = 0, i.e. the lower bracketing level
+            t = np.where(np.isfinite(t), t, 0.0)
+            h = np.exp(l0 + t * (l1 - l0))
+
+            below = n_above == 0
+            above = n_above == nlevels
+            if out_of_range == 'clamp':
+                h = np.where(below, levels[..., 0], h)
+                h = np.where(above, levels[..., -1], h)
+            else:
+                h = np.where(below | above, np.nan, h)
+            haz[..., i] = h
+
+    haz[np.isnan(values).any(axis=-1)] = np.nan
+    return haz
+
+
+def compute_hazard_at_poes(levels: NDArray, values: NDArray, poes: NDArray, inv_time: float, out_of_range: str = 'clamp') -> NDArray:
+    """
+    intensity at each probability of exceedance in inv_time for all hazard curves in one pass
+
+    :param levels: intensity levels, shape [n_levels] or broadcastable to values
+    :param values: hazard curves (apoe), shape [..., n_levels]
+    :param poes: probabilities of exceedance in inv_time, shape [n_poes]
+    :param inv_time: investigation time
+    :param out_of_range: 'clamp' or 'nan', see interp_loglog_inverse
+
+    :return: intensities with shape [..., n_poes]
+    """
+
+    rp = rp_from_poe(np.atleast_1d(np.asarray(poes, dtype='float64')), inv_time)
+    return interp_loglog_inverse(levels, values, 1/rp, out_of_range)
+
+
 def interp_hazard(levels: NDArray, values: NDArray, poe: float, inv_time: float) -> NDArray:
     
-    rp = -inv_time/np.log(1-poe)
-    try:
-        haz = np.exp( np.interp( np.log(1/rp), np.flip(np.log(values)), np.flip(np.log(levels)) ) )
-    except:
-        breakpoint()
-    return haz
+    return compute_hazard_at_poes(levels, values, [poe], inv_time)[..., 0]
 
 
 def compute_hazard_at_poe(levels: NDArray,values: NDArray, poe: float, inv_time: float) -> NDArray:
 
-    # TODO: fix calls to cast args to NDArray before using this function 
-    if len(values.shape) == 1:
-        return interp_hazard(levels, values, poe, inv_time)
-    else:
-        nrows = values.shape[0]
-        haz = np.empty((nrows,))
-        for row_i in range(values.shape[0]):
-            haz[row_i] = interp_hazard(levels, values[row_i,:], poe, inv_time)
-    return haz
+    haz = interp_hazard(np.asarray(levels), np.asarray(values), poe, inv_time)
+    return haz[()] if haz.ndim == 0 else haz
 
 
 def get_poe_df(hazard: DataFrame, locations: List[CodedLocation], imt, agg, poe, inv_time):
 
+    if isinstance(hazard, HazardCube):
+        levels, values = hazard.curves(locations, imt, agg)
+        haz_poe = pd.DataFrame(columns = ['lat', 'lon', 'level'], index = range(len(locations)), dtype='float64')
+        haz_poe['level'] = compute_hazard_at_poe(levels, values, poe, inv_time)
+        haz_poe['lat'] = [loc.lat for loc in locations]
+        haz_poe['lon'] = [loc.lon for loc in locations]
+        return haz_poe
+
     hazard = hazard.loc[(hazard['agg'] == agg) & (hazard['imt'] == imt)]
     hazard['location_code'] = hazard['lat'] + '~' + hazard['lon']
     location_codes = [loc.code for loc in locations]
@@ -105,20 +175,61 @@ def weighted_quantile(values, quantiles, sample_weight=None,
         weighted_quantiles /= np.sum(sample_weight)
     return np.interp(quantiles, weighted_quantiles, values)
 
-    
 
-# def calculate_agg(hazard_data, location, imt, agg):
-#     for irlz in range(hazard_data.nrlzs):
-#         if irlz == 0:
-#             levels = np.array(hazard_data.values(location=location,imt=imt,realization=irlz).lvls)
-#             values = np.array(hazard_data.values(location=location,imt=imt,realization=irlz).vals)
-#         else:
-#             values = np.vstack((values,np.array(hazard_data.values(location=location,imt=imt,realization=irlz).vals)))
-
-#     weights = np.array(list(hazard_data.rlz_lt['weight'].values()))
-#     agg_values = np.array([]) #TODO pre-allocate memory
-#     for i,level in enumerate(levels):
-#         quantiles = weighted_quantile(values[:,i],[agg],sample_weight=weights)
-#         agg_values = np.append(agg_values,np.array(quantiles))
-
-#     return agg_values
+def weighted_quantiles(values: NDArray, quantiles, sample_weight=None,
+                       values_sorted: bool = False, old_style: bool = False) -> NDArray:
+    """
+    weighted_quantile for many distributions at once. The values are sorted once along the last
+    (realization) axis and every quantile is interpolated for all distributions in the same pass.
+    The results match weighted_quantile applied to each distribution.
+
+    :param values: array [..., n_rlz]
+    :param quantiles: list of quantiles in [0, 1]; any entry may be 'mean' for the weighted mean
+    :param sample_weight: array-like of length n_rlz shared by all distributions
+    :param values_sorted: bool, if True the values are already sorted along the last axis
+    :param old_style: if True, will correct output to be consistent with numpy.percentile.
+    :return: array [..., n_quantiles]
+    """
+
+    values = np.asarray(values, dtype='float64')
+    n_rlz = values.shape[-1]
+    if sample_weight is None:
+        sample_weight = np.ones(n_rlz)
+    sample_weight = np.asarray(sample_weight, dtype='float64')
+    if isinstance(quantiles, str) or np.ndim(quantiles) == 0:
+        quantiles = [quantiles]
+
+    is_mean = [isinstance(q, str) and q == 'mean' for q in quantiles]
+    probs = np.array([0.0 if mean else q for q, mean in zip(quantiles, is_mean)], dtype='float64')
+    assert np.all(probs >= 0) and np.all(probs <= 1), 'quantiles should be in [0, 1]'
+
+    out = np.empty(values.shape[:-1] + (len(quantiles),))
+    if any(is_mean):
+        weighted_mean = np.sum(sample_weight * values, axis=-1)
+
+    if not all(is_mean):
+        if values_sorted:
+            weights = np.broadcast_to(sample_weight, values.shape)
+        else:
+            sorter = np.argsort(values, axis=-1)
+            values = np.take_along_axis(values, sorter, axis=-1)
+            weights = sample_weight[sorter]
+
+        cdf = np.cumsum(weights, axis=-1) - 0.5 * weights
+        if old_style:
+            # To be convenient with numpy.percentile
+            cdf -= cdf[..., :1]
+            cdf /= cdf[..., -1:]
+        else:
+            cdf /= np.sum(weights, axis=-1, keepdims=True)
+
+    for i, (q, mean) in enumerate(zip(probs, is_mean)):
+        out[..., i] = weighted_mean if mean else interp_rows(q, cdf, values)
+
+    return out
+
+
+def calculate_agg(hazard_data, location, imt, agg):
+    """weighted quantile (or 'mean') of the realizations at each level, see HazardData.aggregate"""
+
+    return hazard_data.aggregate(location, imt, agg)
@@ -1,10 +1,13 @@
 from zipfile import ZipFile
-import itertools
 import io
 from collections import namedtuple
 import csv
 import numpy as np
 import numpy.typing as npt
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
 
 AXIS_MAG = 0
 AXIS_DIST = 1
@@ -28,171 +31,310 @@ def rate_to_prob(rate: npt.ArrayLike) -> npt.ArrayLike:
 
     return 1.0 - np.exp(-INV_TIME * rate)
 
-def calc_mode_disagg(disagg, bins, dimensions):
+DisaggStats = namedtuple("DisaggStats", "total marginals means modes")
+
+
+def calc_disagg_stats(disaggs, bins, mode_dimensions=()):
+    """
+    statistics of many disaggregations at once. Probabilities are converted to rates once and the
+    marginal sums are built from shared partial sums.
+
+    :param disaggs: probabilities [n_disagg, mag, dist, trt, eps]
+    :param bins: bin centres for each of the mag, dist, trt and eps axes (shared by all disaggs)
+    :param mode_dimensions: the sets of dimensions (e.g. ('mag', 'dist')) to find the mode over
+
+    :return: DisaggStats with the total rate [n_disagg], the marginal rates {dim: [n_disagg, n_bins]},
+        the means {'mag', 'dist', 'eps': [n_disagg]} and for each set of mode dimensions a tuple of the
+        mode bins {dim: [n_disagg]} and the fractional contribution of the mode [n_disagg]
+    """
+
+    rates = prob_to_rate(np.asarray(disaggs, dtype='float64'))
+    n_disagg = rates.shape[0]
+
+    # partial sums reused for the marginals and modes, [n, mag, dist, trt] and [n, mag, dist]
+    mdt = np.sum(rates, axis=1 + AXIS_EPS)
+    md = np.sum(mdt, axis=1 + AXIS_TRT)
+    marginals = dict(
+        mag = np.sum(md, axis=1 + AXIS_DIST),
+        dist = np.sum(md, axis=1 + AXIS_MAG),
+        trt = np.sum(mdt, axis=(1 + AXIS_MAG, 1 + AXIS_DIST)),
+        eps = np.sum(rates, axis=(1 + AXIS_MAG, 1 + AXIS_DIST, 1 + AXIS_TRT)),
+    )
+    total = np.sum(marginals['mag'], axis=1)
+
+    means = {
+        dim: np.sum(marginals[dim] / total[:, None] * np.asarray(bins[AXIS_NUMS[dim]], dtype='float64'), axis=1)
+        for dim in ('dist', 'mag', 'eps')
+    }
+
+    modes = {}
+    for dimensions in mode_dimensions:
+        keep_dims = tuple(d for d in AXIS_NUMS.keys() if d in dimensions)
+        if len(keep_dims) == 1:
+            disagg = marginals[keep_dims[0]]
+        else:
+            if set(keep_dims) <= {'mag', 'dist'}:
+                partial, partial_dims = md, ('mag', 'dist')
+            elif set(keep_dims) <= {'mag', 'dist', 'trt'}:
+                partial, partial_dims = mdt, ('mag', 'dist', 'trt')
+            else:
+                partial, partial_dims = rates, tuple(AXIS_NUMS.keys())
+            sum_dims = tuple(1 + i for i, d in enumerate(partial_dims) if d not in keep_dims)
+            disagg = np.sum(partial, axis=sum_dims) if sum_dims else partial
+
+        disagg = disagg.reshape(n_disagg, -1) / total[:, None]
+        mode_flat = np.argmax(disagg, axis=1)
+        mode_ind = np.unravel_index(mode_flat, tuple(len(bins[AXIS_NUMS[d]]) for d in keep_dims))
+        mode = {dim: np.asarray(bins[AXIS_NUMS[dim]])[mode_ind[i]] for i, dim in enumerate(keep_dims)}
+        contribution = disagg[np.arange(n_disagg), mode_flat]
+        modes[tuple(dimensions)] = (mode, contribution)
+
+    return DisaggStats(total, marginals, means, modes)
 
-    disagg = prob_to_rate(disagg)
-    
-    sum_dims = tuple(AXIS_NUMS[d] for d in AXIS_NUMS.keys() if d not in dimensions)
-    keep_dims = tuple(d for d in AXIS_NUMS.keys() if d in dimensions)
 
-    disagg = np.sum(disagg, axis=sum_dims)
-    disagg = disagg / np.sum(disagg)
-    
-    mode_ind = np.where(disagg == disagg.max())
-    mode = {}
-    for i, dim in enumerate(keep_dims):
-        mode[dim] = float(bins[AXIS_NUMS[dim]][mode_ind[i][0]])
+def calc_mode_disagg(disagg, bins, dimensions):
 
-    contribution = disagg.max()
+    mode, contribution = calc_disagg_stats(np.asarray(disagg)[None], bins, (tuple(dimensions),)).modes[tuple(dimensions)]
+    mode = {dim: float(values[0]) if dim != 'trt' else str(values[0]) for dim, values in mode.items()}
 
-    return mode, contribution
+    return mode, float(contribution[0])
 
 
 def calc_mean_disagg(disagg, bins):
 
-    disagg = prob_to_rate(disagg)
-    dist_mean = np.sum(np.sum(disagg, axis = (AXIS_MAG, AXIS_TRT, AXIS_EPS) ) / np.sum(disagg) * bins[AXIS_DIST])
-    mag_mean = np.sum(np.sum(disagg, axis = (AXIS_DIST, AXIS_TRT, AXIS_EPS) ) / np.sum(disagg) * bins[AXIS_MAG])
-    eps_mean = np.sum(np.sum(disagg, axis = (AXIS_MAG, AXIS_DIST, AXIS_TRT) ) / np.sum(disagg) * bins[AXIS_EPS])
+    means = calc_disagg_stats(np.asarray(disagg)[None], bins).means
+
+    return dict(dist = float(means['dist'][0]), mag = float(means['mag'][0]), eps = float(means['eps'][0]))
+
+
+def _mag_dist_grid(mags, dists):
+    """
+    the [dist, mag] meshgrid of the unique magnitudes and distances and the (row, col) cell of each
+    entry. Raises ValueError if any (mag, dist) combination is missing or repeated.
+    """
 
-    return dict(dist = dist_mean, mag = mag_mean, eps = eps_mean)
+    umags, col = np.unique(np.asarray(mags), return_inverse=True)
+    udists, row = np.unique(np.asarray(dists), return_inverse=True)
+    row, col = row.ravel(), col.ravel()
+
+    counts = np.bincount(row * len(umags) + col, minlength=len(udists) * len(umags)).reshape(len(udists), len(umags))
+    if (counts == 0).any():
+        missing = [(float(umags[c]), float(udists[r])) for r, c in zip(*np.nonzero(counts == 0))]
+        raise ValueError(f'missing (mag, dist) combinations: {missing}')
+    if (counts > 1).any():
+        repeated = [(float(umags[c]), float(udists[r])) for r, c in zip(*np.nonzero(counts > 1))]
+        raise ValueError(f'repeated (mag, dist) combinations: {repeated}')
+
+    Mags, Dists = np.meshgrid(umags.astype(float), udists.astype(float))
+    return Mags, Dists, row, col
 
 
 def meshgrid_disaggs(mags,dists,rates_int,rates_slab,rates_cru):
 
-    umags = list(set(mags))
-    umags.sort()
-    udists = list(set(dists))
-    udists.sort()
-
-    nmags = len(umags)
-    ndists = len(udists)
-    
-
-    Mags = np.empty((ndists,nmags))
-    Dists = np.empty((ndists,nmags))
-    Rates_int = np.empty((ndists,nmags))
-    Rates_slab = np.empty((ndists,nmags))
-    Rates_cru = np.empty((ndists,nmags))
-    Rates_tot = np.empty((ndists,nmags))
-
-    for col,mag in enumerate(umags):
-        for row,dist in enumerate(udists):
-
-            Mags[row,col] = mag
-            Dists[row,col] = dist
-            ind = (mags==mag) & (dists==dist)
-            Rates_int[row,col] = rates_int[ind]
-            Rates_cru[row,col] = rates_cru[ind]
-            Rates_slab[row,col] = rates_slab[ind]
-            Rates_tot[row,col] = rates_int[ind] + rates_cru[ind] + rates_slab[ind]
+    Mags, Dists, row, col = _mag_dist_grid(mags, dists)
+
+    Rates_int = np.empty(Mags.shape)
+    Rates_slab = np.empty(Mags.shape)
+    Rates_cru = np.empty(Mags.shape)
+
+    Rates_int[row,col] = rates_int
+    Rates_cru[row,col] = rates_cru
+    Rates_slab[row,col] = rates_slab
+    Rates_tot = Rates_int + Rates_cru + Rates_slab
 
     return Mags, Dists, Rates_int, Rates_slab, Rates_cru, Rates_tot
 
 
 def meshgrid_disaggs_v2(mags,dists,rates):
 
-    umags = list(set(mags))
-    umags.sort()
-    udists = list(set(dists))
-    udists.sort()
+    Mags, Dists, row, col = _mag_dist_grid(mags, dists)
+
+    Rates = np.empty(Mags.shape)
+    Rates[row,col] = rates
+            
+    return Mags, Dists, Rates
 
-    nmags = len(umags)
-    ndists = len(udists)
-    
 
-    Mags = np.empty((ndists,nmags))
-    Dists = np.empty((ndists,nmags))
-    Rates = np.empty((ndists,nmags))
 
-    for col,mag in enumerate(umags):
-        for row,dist in enumerate(udists):
+DisaggCSV = namedtuple("DisaggCSV", "values bins dims columns")
 
-            Mags[row,col] = mag
-            Dists[row,col] = dist
-            ind = (mags==mag) & (dists==dist)
-            Rates[row,col] = rates[ind]
-            
-    return Mags, Dists, Rates
+# columns of OpenQuake disagg CSVs that index the disaggregation, in the order of the output axes
+DISAGG_CSV_DIMS = ('site_id', 'imt', 'poe', 'mag', 'dist', 'lon', 'lat', 'trt', 'eps')
+# columns that are neither dimensions nor values
+DISAGG_CSV_IGNORE = ('iml',)
+
+
+def read_disagg_csv(csv_archive, member='Mag_Dist_TRT-0_1.csv', fill=0.0):
+    """
+    parse any OpenQuake disaggregation CSV (Mag_Dist, Mag_Dist_Eps, Mag_Dist_TRT, Mag_Dist_TRT_Eps, ...)
+    into a dense array. The file is read straight from the zip archive with the pyarrow CSV reader; the
+    first (comment) row is skipped.
+
+    :param csv_archive: zip archive of OQ CSV outputs (path or file object), or the CSV itself if member is None
+    :param member: name of the CSV in the archive
+    :param fill: value for bins with no row in the file
+
+    :return: DisaggCSV with values [*dims, column], the bins along each dimension (numeric bins sorted,
+        others in order of appearance), the dimension names and the value column names (rlz0, mean, ...)
+    """
+
+    read_options = pacsv.ReadOptions(skip_rows=1)
+    if member is None:
+        table = pacsv.read_csv(csv_archive, read_options=read_options)
+    else:
+        with ZipFile(csv_archive) as zipf, zipf.open(member) as csv_file:
+            table = pacsv.read_csv(csv_file, read_options=read_options)
+
+    dims = tuple(d for d in DISAGG_CSV_DIMS if d in table.column_names)
+    columns = [c for c in table.column_names if c not in dims and c not in DISAGG_CSV_IGNORE]
 
+    bins, codes = [], []
+    for dim in dims:
+        col = table.column(dim)
+        if pa.types.is_integer(col.type) or pa.types.is_floating(col.type):
+            dim_bins, dim_codes = np.unique(col.to_numpy(), return_inverse=True)
+        else:
+            dim_bins = pc.unique(col)
+            dim_codes = pc.index_in(col, value_set=dim_bins).to_numpy()
+            dim_bins = np.array(dim_bins.to_pylist(), dtype=object)
+        bins.append(dim_bins)
+        codes.append(dim_codes.ravel())
 
+    shape = tuple(len(b) for b in bins)
+    cells = np.ravel_multi_index(codes, shape) if dims else np.zeros(table.num_rows, dtype=int)
+    if len(np.unique(cells)) != len(cells):
+        raise ValueError(f'{member or csv_archive} has more than one row for some bins')
 
-def get_disagg_trt(csv_archive):
-    hazard = {}
-    with ZipFile(csv_archive) as zipf:
-        with io.TextIOWrapper(zipf.open('Mag_Dist_TRT-0_1.csv'), encoding="utf-8") as mag_dist_TRT_file:
-            disagg_reader = csv.reader(mag_dist_TRT_file)
-            junk = next(disagg_reader)
-            header = next(disagg_reader)
-            DisaggData = namedtuple("DisaggData", header, rename=True)
-            for row in disagg_reader:
-                disagg_data = DisaggData(*row)
-                trt = disagg_data.trt
-                prob = disagg_data.rlz0
-                if not hazard.get(trt):
-                    hazard[trt] = float(prob)
-                else:
-                    hazard[trt] += float(prob)
-
-    return hazard
-
-def get_disagg_MDT(csv_archive):
-
-    with ZipFile(csv_archive) as zipf:
-        with io.TextIOWrapper(zipf.open('Mag_Dist_TRT-0_1.csv'), encoding="utf-8") as mag_dist_TRT_file:
-            disagg_reader = csv.reader(mag_dist_TRT_file)
-            junk = next(disagg_reader)
-            header = next(disagg_reader)
-            DisaggData = namedtuple("DisaggData", header, rename=True)
-            mags = []
-            dists = []
-            rates_slab = []
-            rates_cru = []
-            rates_int = []
-
-            for row in disagg_reader:
-                disagg_data = DisaggData(*row)
-
-                mag = float(disagg_data.mag)
-                dist = float(disagg_data.dist)
-                rate = float(disagg_data.rlz0)
-                trt = disagg_data.trt
-
-
-                if trt == 'Active Shallow Crust':
-                    mags.append(mag)
-                    dists.append(dist)
-                    rates_cru.append(rate)
-                    # rates_slab.append(0.0)
-                    # rates_int.append(0.0)
-                elif trt == 'Subduction Interface':
-                    rates_int.append(rate)
-                    # rates_slab.append(0.0)
-                    # rates_cru.append(0.0)
-                elif trt == 'Subduction Intraslab':
-                    rates_slab.append(rate)
-                    # rates_int.append(0.0)
-                    # rates_cru.append(0.0)
-
-    mags = np.array(mags)
-    dists = np.array(dists)
-    rates_int = np.array(rates_int)
-    rates_slab = np.array(rates_slab)
-    rates_cru = np.array(rates_cru)
+    values = np.full((int(np.prod(shape)), len(columns)), fill, dtype='float64')
+    for i, column in enumerate(columns):
+        values[cells, i] = table.column(column).to_numpy()
+
+    return DisaggCSV(values.reshape(shape + (len(columns),)), bins, dims, columns)
+
+
+def get_disagg_trt(csv_archive, member='Mag_Dist_TRT-0_1.csv', column='rlz0'):
+
+    disagg = read_disagg_csv(csv_archive, member)
+    values = disagg.values[..., disagg.columns.index(column)]
+    i_trt = disagg.dims.index('trt')
+    probs = np.sum(values, axis=tuple(i for i in range(values.ndim) if i != i_trt))
+
+    return {trt: float(prob) for trt, prob in zip(disagg.bins[i_trt], probs)}
+
+def get_disagg_MDT(csv_archive, member='Mag_Dist_TRT-0_1.csv', column='rlz0'):
+    """
+    magnitude, distance and the crustal, interface and slab values of each (mag, dist) bin as flat arrays,
+    summed over any other dimension in the file. Tectonic regions not in the file are zero.
+    """
+
+    disagg = read_disagg_csv(csv_archive, member)
+    values = disagg.values[..., disagg.columns.index(column)]
+    keep = [disagg.dims.index(d) for d in ('mag', 'dist', 'trt')]
+    values = np.sum(values, axis=tuple(i for i in range(values.ndim) if i not in keep))
+    trts = list(disagg.bins[keep[2]])
+
+    def trt_rates(trt):
+        return values[..., trts.index(trt)].ravel() if trt in trts else np.zeros(values.shape[0] * values.shape[1])
+
+    Mags, Dists = np.meshgrid(disagg.bins[keep[0]], disagg.bins[keep[1]], indexing='ij')
+    mags = Mags.ravel()
+    dists = Dists.ravel()
+    rates_cru = trt_rates('Active Shallow Crust')
+    rates_int = trt_rates('Subduction Interface')
+    rates_slab = trt_rates('Subduction Intraslab')
 
     return mags,dists,rates_int,rates_slab,rates_cru
 
 
-def disagg_to_csv(disagg, bins, header, csv_filepath):
+DISAGG_COLUMNS = ['magnitude','distance (km)','TRT','epsilon (sigma)','annual probability of exceedance', '% contribution to hazard']
 
-    disagg = disagg.flatten()
+
+def _csv_field(value):
+    """a single field quoted as csv.writer would"""
+
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator='').writerow([value])
+    return buffer.getvalue()
+
+
+def _disagg_columns(disagg, bins):
+    """bin centres of every cell (in itertools.product(*bins) order), probabilities and % contributions"""
+
+    disagg = np.asarray(disagg).flatten()
     disagg_pc = prob_to_rate(disagg)
     disagg_pc = disagg_pc / np.sum(disagg_pc) * 100.0
-    with open(csv_filepath, 'w') as csvfile:
+    grids = np.meshgrid(*(np.arange(len(b)) for b in bins), indexing='ij')
+    return [g.ravel() for g in grids], disagg, disagg_pc
+
+
+def disagg_to_csv(disagg, bins, header, csv_filepath):
+    """
+    write a disaggregation as CSV, one row per (mag, dist, trt, eps) bin. Bin labels are formatted once per
+    bin and the values in bulk, giving the same file as writing each row with csv.writer.
+    """
+
+    (i_mag, i_dist, i_trt, i_eps), disagg, disagg_pc = _disagg_columns(disagg, bins)
+
+    mag_labels = np.array([f'{mag:0.1f}' for mag in bins[AXIS_MAG]], dtype=object)
+    dist_labels = np.array([f'{dist:0.0f}' for dist in bins[AXIS_DIST]], dtype=object)
+    trt_labels = np.array([_csv_field(trt) for trt in bins[AXIS_TRT]], dtype=object)
+    eps_labels = np.array([f'{eps:0.3f}' for eps in bins[AXIS_EPS]], dtype=object)
+
+    fields = np.empty((len(disagg), 6), dtype=object)
+    fields[:, 0] = mag_labels[i_mag]
+    fields[:, 1] = dist_labels[i_dist]
+    fields[:, 2] = trt_labels[i_trt]
+    fields[:, 3] = eps_labels[i_eps]
+    fields[:, 4] = disagg.tolist()
+    fields[:, 5] = disagg_pc.tolist()
+
+    with open(csv_filepath, 'w', newline='') as csvfile:
         writer = csv.writer(csvfile)
         writer.writerow([header])
-        writer.writerow(['magnitude','distance (km)','TRT','epsilon (sigma)','annual probability of exceedance', '% contribution to hazard'])
-        for i, (mag, dist, trt, eps) in enumerate(itertools.product(*bins)):
-            row = (f'{mag:0.1f}', f'{dist:0.0f}', trt, f'{eps:0.3f}', f'{disagg[i]:0.3e}', f'{disagg_pc[i]:0.3e}')
-            writer.writerow(row)
-
+        writer.writerow(DISAGG_COLUMNS)
+        # one formatting pass over all rows
+        csvfile.write(('%s,%s,%s,%s,%0.3e,%0.3e\r\n' * len(fields)) % tuple(fields.ravel()))
+
+
+def disagg_to_parquet(disagg, bins, header, parquet_filepath):
+    """
+    write a disaggregation as a Parquet table with the columns of disagg_to_csv (full precision, the TRT
+    dictionary encoded) and the header in the schema metadata
+    """
+
+    (i_mag, i_dist, i_trt, i_eps), disagg, disagg_pc = _disagg_columns(disagg, bins)
+    trts = pa.array([str(trt) for trt in bins[AXIS_TRT]])
+
+    table = pa.table({
+        DISAGG_COLUMNS[0]: np.asarray(bins[AXIS_MAG], dtype='float64')[i_mag],
+        DISAGG_COLUMNS[1]: np.asarray(bins[AXIS_DIST], dtype='float64')[i_dist],
+        DISAGG_COLUMNS[2]: pa.DictionaryArray.from_arrays(pa.array(i_trt, type=pa.int32()), trts),
+        DISAGG_COLUMNS[3]: np.asarray(bins[AXIS_EPS], dtype='float64')[i_eps],
+        DISAGG_COLUMNS[4]: disagg,
+        DISAGG_COLUMNS[5]: disagg_pc,
+    })
+    table = table.replace_schema_metadata({'header': header})
+    pq.write_table(table, parquet_filepath)
+
+
+def disagg_to_npz(disagg, bins, header, npz_filepath):
+    """
+    write the dense disaggregation array and its bins with np.savez_compressed
+    """
+
+    np.savez_compressed(
+        npz_filepath,
+        disagg=np.asarray(disagg),
+        mag=np.asarray(bins[AXIS_MAG], dtype='float64'),
+        dist=np.asarray(bins[AXIS_DIST], dtype='float64'),
+        trt=np.asarray([str(trt) for trt in bins[AXIS_TRT]]),
+        eps=np.asarray(bins[AXIS_EPS], dtype='float64'),
+        header=np.asarray(header),
+    )
+
+
+DISAGG_WRITERS = dict(
+    csv = disagg_to_csv,
+    parquet = disagg_to_parquet,
+    npz = disagg_to_npz,
+)
@@ -0,0 +1,127 @@
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+from numpy.typing import NDArray
+
+from nzshm_common.location import CodedLocation
+
+
+def _axis_index(labels: Sequence[str]) -> Dict[str, int]:
+    return {label: i for i, label in enumerate(labels)}
+
+
+class HazardCube:
+    """
+    dense in-memory hazard curves indexed [location, imt, agg, level]
+
+    Locations, imts and aggs are integer coded; the mapping from label to position along each axis is
+    held in the location_index, imt_index and agg_index dicts. Levels are stored per imt as a
+    [imt, level] array. Curves that are not available are filled with NaN.
+    """
+
+    def __init__(
+            self,
+            values: NDArray,
+            levels: NDArray,
+            locations: Sequence[str],
+            imts: Sequence[str],
+            aggs: Sequence[str],
+            location_aliases: Optional[Dict[str, str]] = None,
+    ):
+        self.values = np.ascontiguousarray(values, dtype='float64')
+        self.levels = np.ascontiguousarray(levels, dtype='float64')
+        self.locations = tuple(locations)
+        self.imts = tuple(imts)
+        self.aggs = tuple(aggs)
+
+        expected_shape = (len(self.locations), len(self.imts), len(self.aggs), self.levels.shape[-1])
+        if self.values.shape != expected_shape:
+            raise ValueError(f'values shape {self.values.shape} does not match axes {expected_shape}')
+        if self.levels.shape != (len(self.imts), expected_shape[-1]):
+            raise ValueError(f'levels shape {self.levels.shape} does not match imts and levels')
+
+        self.location_index = _axis_index(self.locations)
+        for alias, location in (location_aliases or {}).items():
+            self.location_index.setdefault(alias, self.location_index[location])
+        self.imt_index = _axis_index(self.imts)
+        self.agg_index = _axis_index(self.aggs)
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return self.values.shape
+
+    def loc_idx(self, location: Union[CodedLocation, str]) -> int:
+        code = location.code if isinstance(location, CodedLocation) else location
+        return self.location_index[code]
+
+    def curve(self, location: Union[CodedLocation, str], imt: str, agg: str) -> Tuple[NDArray, NDArray]:
+        """levels and apoe for a single location, imt and agg"""
+
+        i_imt = self.imt_index[imt]
+        return self.levels[i_imt], self.values[self.loc_idx(location), i_imt, self.agg_index[agg]]
+
+    def curves(self, locations: Sequence[Union[CodedLocation, str]], imt: str, agg: str) -> Tuple[NDArray, NDArray]:
+        """levels and [location, level] apoe block for many locations, one imt and agg"""
+
+        i_imt = self.imt_index[imt]
+        idx = [self.loc_idx(loc) for loc in locations]
+        return self.levels[i_imt], self.values[idx, i_imt, self.agg_index[agg]]
+
+    @classmethod
+    def from_curves_df(cls, hazard_curves: DataFrame) -> 'HazardCube':
+        """
+        build from the output of store.curves.get_hazard or store.curves_v4.get_hazard (one row per
+        location, imt, and agg with array valued level and apoe columns)
+        """
+
+        location_codes = (hazard_curves['lat'] + '~' + hazard_curves['lon']).to_numpy()
+        loc_codes, locations = pd.factorize(location_codes)
+        imt_codes, imts = pd.factorize(hazard_curves['imt'].to_numpy())
+        agg_codes, aggs = pd.factorize(hazard_curves['agg'].to_numpy())
+
+        apoe = np.stack(hazard_curves['apoe'].to_numpy()).astype('float64')
+        level_rows = np.stack(hazard_curves['level'].to_numpy()).astype('float64')
+        nlevels = apoe.shape[1]
+
+        levels = np.empty((len(imts), nlevels))
+        first_rows = np.unique(imt_codes, return_index=True)[1]
+        levels[imt_codes[first_rows]] = level_rows[first_rows]
+
+        values = np.full((len(locations), len(imts), len(aggs), nlevels), np.nan)
+        values[loc_codes, imt_codes, agg_codes] = apoe
+
+        return cls(values, levels, list(locations), list(imts), list(aggs))
+
+    @classmethod
+    def from_legacy_data(cls, data: dict, intensity_type: str = 'acc') -> 'HazardCube':
+        """
+        build from the statistics in the legacy data structure produced by read_oq_hazstore.retrieve_data
+        (or read_oq_hdf5.retrieve_data). Locations are keyed by custom_site_id and may also be looked up
+        by site name. Site collections without a custom_site_id (e.g. some hdf5 files) are keyed by site
+        name (or index if the sites are not named).
+        """
+
+        imtls = data['metadata'][f'{intensity_type}_imtls']
+        imts = list(imtls.keys())
+        levels = np.array([imtls[imt] for imt in imts], dtype='float64')
+        aggs = ['mean'] + [str(q) for q in data['metadata']['quantiles']]
+
+        sites = data['metadata']['sites']
+        if 'custom_site_id' in sites:
+            names = list(sites['custom_site_id'].keys())
+            site_ids = list(sites['custom_site_id'].values())
+        else:
+            names = list(next(iter(sites.values())).keys())
+            site_ids = [str(name) for name in names]
+        if 'sids' in sites:
+            order = np.argsort([sites['sids'][name] for name in names], kind='stable')
+            names = [names[i] for i in order]
+            site_ids = [site_ids[i] for i in order]
+
+        # legacy order is [site, imt, imtl, stat]
+        values = np.moveaxis(np.asarray(data['hcurves']['hcurves_stats'], dtype='float64'), 3, 2)
+        aliases = {name: site_id for name, site_id in zip(names, site_ids)}
+
+        return cls(values, levels, site_ids, imts, aggs, location_aliases=aliases)
@@ -1,57 +1,203 @@
 import ast
-from collections import UserDict, namedtuple
-from functools import lru_cache
+import warnings
+from collections import OrderedDict, UserDict, namedtuple
+from functools import cached_property, lru_cache
 
+import numpy as np
 from toshi_hazard_store import query
 
+from nzshm_hazlab.data_functions import weighted_quantiles
+from nzshm_hazlab.store.curves import chunks, fetch_chunked
+
+Key = namedtuple("Key","imt location realization")
+CacheInfo = namedtuple("CacheInfo","hits misses evictions nbytes max_bytes")
+
+DEFAULT_CACHE_BYTES = 512 * 1024**2
+
 def encode_key(imt,location,realization):
     realization = f'{int(realization):05d}' if str(realization).isdigit() else realization        
     return ':'.join(map(str,(imt,location,realization)))
 
 def decode_key(key):
-    Key = namedtuple("Key","imt location realization")
     key_tuple = Key(*key.split(':'))
     return key_tuple
 
+def as_key(key):
+    """Key tuple from an encoded key string or an (imt, location, realization) tuple"""
+    if isinstance(key, str):
+        return decode_key(key)
+    imt, location, realization = key
+    realization = f'{int(realization):05d}' if str(realization).isdigit() else str(realization)
+    return Key(imt, location, realization)
+
 
 class LazyData(UserDict):
+    """
+    curves loaded on demand from toshi-hazard-store, keyed by Key(imt, location, realization)
+
+    Curve values are held as ndarrays of the given dtype and the levels are shared by all curves of an
+    imt. Arrays derived from the curves (see get_derived/put_derived) are held under the same bound. The
+    total size is bounded by max_bytes; derived arrays are evicted before curves, least recently used first.
+    The curves of the location loaded by a miss are never evicted by that miss, so a bound smaller than one
+    location (which gives a warning) is exceeded rather than re-querying the location for every curve.
+    """
 
     Values = namedtuple("Values","lvls vals")
 
-    def __init__(self,hazard_id):
+    def __init__(self,hazard_id,max_bytes=DEFAULT_CACHE_BYTES,dtype='float64'):
         self._hazard_id = hazard_id 
+        self._max_bytes = max_bytes
+        self._dtype = np.dtype(dtype)
+        self._loaded = set()
+        self._lvls = {}
+        self._derived = OrderedDict()
+        self._nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
         super().__init__()
+        self.data = OrderedDict()
 
     def __getitem__(self, key):
-        if not self.data.get(key):
-            q = self._run_query(key)
-            k = decode_key(key)
+        k = as_key(key)
+        if k in self.data:
+            self.hits += 1
+            self.data.move_to_end(k)
+        else:
+            self.misses += 1
+            q = self._run_query(k)
 
             if k.realization.isdigit():
-                self._load_all_rlz(q,k)
+                loaded = self._load_all_rlz(q,k)
+                self._loaded.add(('rlz', k.location))
             else:
-                self._load_all_agg(q,k)
+                loaded = self._load_all_agg(q,k)
+                self._loaded.add(('stats', k.location))
 
-        return self.data[key]
+            if k in self.data:
+                self.data.move_to_end(k)
+            self._check_footprint(k.location, loaded)
+            self._evict(protect=set(loaded))
+
+        return self.data[k]
 
     def __setitem__(self, key, item) -> None:
         raise Exception("LazyData: cannot set items")
 
+    def __contains__(self, key):
+        return as_key(key) in self.data
+
+    def clear(self):
+        self.data.clear()
+        self._loaded.clear()
+        self._lvls.clear()
+        self._derived.clear()
+        self._nbytes = 0
+
+    def cache_info(self):
+        return CacheInfo(self.hits, self.misses, self.evictions, self._nbytes, self._max_bytes)
+
+    def prefetch(self, locations, imts=None, kind='rlz', chunk_size=10, max_workers=4):
+        """
+        load the curves for many locations with one query per chunk of locations, running the queries
+        concurrently. Locations already loaded in full are skipped.
+        """
+
+        if kind == 'rlz':
+            query_fn = query.get_hazard_rlz_curves_v2
+        elif kind == 'stats':
+            query_fn = query.get_hazard_stats_curves_v2
+        else:
+            raise ValueError(f"kind must be 'rlz' or 'stats', not {kind}")
+
+        pending = [loc for loc in dict.fromkeys(locations) if (kind, loc) not in self._loaded]
+        chunk_args = [(self._hazard_id, imts, locs, None) for locs in chunks(pending, chunk_size)]
+        for res in fetch_chunked(query_fn, chunk_args, max_workers=max_workers):
+            for re in res:
+                label = re.rlz if kind == 'rlz' else re.agg
+                for val_imt in re.values:
+                    self._store(as_key((val_imt.imt, re.loc, label)), val_imt)
+
+        if imts is None:
+            self._loaded.update((kind, loc) for loc in pending)
+        self._evict()
+
+    def _store(self, k, val_imt):
+        vals = np.asarray(val_imt.vals, dtype=self._dtype)
+        lvls = self._lvls.get(k.imt)
+        if lvls is None or not np.array_equal(lvls, val_imt.lvls):
+            lvls = np.asarray(val_imt.lvls, dtype='float64')
+            self._lvls.setdefault(k.imt, lvls)
+
+        old = self.data.pop(k, None)
+        if old is not None:
+            self._nbytes -= old.vals.nbytes
+        self.data[k] = self.Values(lvls=lvls,vals=vals)
+        self._nbytes += vals.nbytes
+
+    def get_derived(self, key):
+        """an array stored with put_derived, or None if it is not (or no longer) held"""
+
+        values = self._derived.get(key)
+        if values is not None:
+            self._derived.move_to_end(key)
+        return values
+
+    def put_derived(self, key, values):
+        """hold an array derived from the curves under the byte bound of the cache"""
+
+        old = self._derived.pop(key, None)
+        if old is not None:
+            self._nbytes -= old.nbytes
+        self._derived[key] = values
+        self._nbytes += values.nbytes
+        self._evict(protect_derived=key)
+
+    def _evict(self, protect=(), protect_derived=None):
+        """
+        drop least recently used entries until the cache fits in max_bytes, skipping the curve keys in
+        protect and the derived key protect_derived
+        """
+
+        for key in list(self._derived):
+            if self._nbytes <= self._max_bytes:
+                return
+            if key != protect_derived:
+                self._nbytes -= self._derived.pop(key).nbytes
+                self.evictions += 1
+        for k in list(self.data):
+            if self._nbytes <= self._max_bytes or len(self.data) <= 1:
+                return
+            if k not in protect:
+                self._nbytes -= self.data.pop(k).vals.nbytes
+                self.evictions += 1
+                self._loaded.discard(('rlz' if k.realization.isdigit() else 'stats', k.location))
+
+    def _check_footprint(self, location, loaded):
+        nbytes = sum(self.data[k].vals.nbytes for k in loaded if k in self.data)
+        if nbytes > self._max_bytes:
+            warnings.warn(
+                f'LazyData: the curves for {location} ({nbytes} bytes) do not fit in max_bytes '
+                f'({self._max_bytes} bytes); the cache will exceed its bound while they are held'
+            )
+
     def _load_all_rlz(self,q,k):
+        loaded = []
         for re in q:
             for val_imt in re.values:
-                new_key = encode_key(val_imt.imt, k.location, re.rlz)
-                self.data[new_key] = self.Values(lvls=val_imt.lvls,vals=val_imt.vals)
+                loaded.append(as_key((val_imt.imt, k.location, re.rlz)))
+                self._store(loaded[-1], val_imt)
+        return loaded
 
     def _load_all_agg(self,q,k):
+        loaded = []
         for re in q:
             for val_imt in re.values:
-                new_key = encode_key(val_imt.imt, k.location, re.agg)
-                self.data[new_key] = self.Values(lvls=val_imt.lvls,vals=val_imt.vals)
+                loaded.append(as_key((val_imt.imt, k.location, re.agg)))
+                self._store(loaded[-1], val_imt)
+        return loaded
 
-    def _run_query(self,key):
-        print('retrieve_data')
-        k = decode_key(key)
+    def _run_query(self,k):
         if k.realization.isdigit():
             q = query.get_hazard_rlz_curves_v2(self._hazard_id,None,[k.location],None)
         else:
@@ -59,72 +205,131 @@ class LazyData(UserDict):
         return q
 
             
+class HazardMetadata:
+    """
+    metadata of a hazard_id from toshi-hazard-store. The logic tree strings are parsed on first use and
+    the realization weights are held as an ndarray.
+    """
+
+    def __init__(self, record):
+        self.imts = record.imts
+        self.vs30 = record.vs30
+        self.aggs = record.aggs
+        self.haz_sol_id = record.haz_sol_id
+        self.hazsol_vs30_rk = record.hazsol_vs30_rk
+        self.locs = record.locs
+        self._record = record
+
+    @cached_property
+    def gsim_lt(self):
+        return ast.literal_eval(self._record.gsim_lt)
+
+    @cached_property
+    def rlz_lt(self):
+        return ast.literal_eval(self._record.rlz_lt)
+
+    @cached_property
+    def src_lt(self):
+        return ast.literal_eval(self._record.src_lt)
+
+    @cached_property
+    def rlz_weights(self):
+        return np.array(list(self.rlz_lt['weight'].values()), dtype='float64')
+
+
+@lru_cache(maxsize=32)
+def get_metadata(hazard_id):
+    """HazardMetadata for a hazard_id, fetched once and shared by all HazardData instances"""
+
+    q = query.get_hazard_metadata([hazard_id])
+    return HazardMetadata(next(q))
+
+
 class HazardData:
 
-    def __init__(self,hazard_id):
+    def __init__(self,hazard_id,cache_bytes=DEFAULT_CACHE_BYTES,dtype='float64'):
         self._hazard_id = hazard_id
-        self._data = LazyData(self._hazard_id) 
-    
+        self._data = LazyData(self._hazard_id,cache_bytes,dtype) 
+        self._meta = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """release the cached curves and aggregates"""
+
+        self._data.clear()
+        self._meta = None
+
     @property
-    @lru_cache(maxsize=None)
     def _hazard_meta(self):
-        print('get_hazard_metadata')
-        return self.get_hazard_metadata()
+        if self._meta is None:
+            self._meta = get_metadata(self._hazard_id)
+        return self._meta
 
     @property
-    @lru_cache(maxsize=None)
     def imts(self):
-        print('imts')
         return self._hazard_meta.imts
 
     @property
-    @lru_cache(maxsize=None)
     def vs30(self):
         return self._hazard_meta.vs30
 
     @property
-    @lru_cache(maxsize=None)
     def aggs(self):
         return self._hazard_meta.aggs
 
     @property
-    @lru_cache(maxsize=None)
     def gsim_lt(self):
-        return ast.literal_eval(self._hazard_meta.gsim_lt)
+        return self._hazard_meta.gsim_lt
 
     @property
-    @lru_cache(maxsize=None)
     def haz_sol_id(self):
         return self._hazard_meta.haz_sol_id
 
     @property
-    @lru_cache(maxsize=None)
     def hazsol_vs30_rk(self):
         return self._hazard_meta.hazsol_vs30_rk
 
     @property
-    @lru_cache(maxsize=None)
     def locs(self):
         return self._hazard_meta.locs
 
     @property
-    @lru_cache(maxsize=None)
     def rlz_lt(self):
-        return ast.literal_eval(self._hazard_meta.rlz_lt)
+        return self._hazard_meta.rlz_lt
 
     @property
-    @lru_cache(maxsize=None)
     def src_lt(self):
-        return ast.literal_eval(self._hazard_meta.src_lt)
+        return self._hazard_meta.src_lt
+
+    @property
+    def rlz_weights(self):
+        return self._hazard_meta.rlz_weights
 
     @property
-    @lru_cache(maxsize=None)
     def nrlzs(self):
-        return len(self.rlz_lt['weight'])
+        return len(self.rlz_weights)
 
     
     
     
+    def prefetch(self, locations, imts=None, kind='rlz', chunk_size=10, max_workers=4):
+        """
+        load the realization (kind='rlz') or aggregate (kind='stats') curves for many locations in batched,
+        concurrent queries so that subsequent calls to values() for these locations are served from memory
+
+        :param locations: location codes
+        :param imts: imts to load (None for all)
+        :param chunk_size: number of locations per query
+        :param max_workers: number of concurrent queries
+        """
+
+        self._data.prefetch(locations, imts, kind, chunk_size, max_workers)
+
     def values(self, location, imt, realization):
 
         #TODO check location and imt agianst avaialable list
@@ -134,13 +339,58 @@ class HazardData:
         #         key = encode_key(location=location,imt=imt,realization=rlz)
         #         _ = self._data[key].values[0]
                 
-        key = encode_key(location=location,imt=imt,realization=realization)
+        key = (imt, location, realization)
         #lvls = self._data[key].values[0].lvls
         #vals = self._data[key].values[0].vals
         
         return self._data[key]
 
 
+    def cache_info(self):
+        """hits, misses, evictions and size in bytes of the curve cache (including realization matrices and aggregates)"""
+
+        return self._data.cache_info()
+
+    def rlz_values(self, location, imt):
+        """
+        all realization curves for a location and imt as a [level, realization] array. The array is kept in
+        the curve cache (counted against cache_bytes) until it is evicted.
+        """
+
+        key = ('rlz_values', location, imt)
+        values = self._data.get_derived(key)
+        if values is None:
+            values = np.empty((len(self.values(location=location, imt=imt, realization=0).vals), self.nrlzs))
+            for irlz in range(self.nrlzs):
+                values[:, irlz] = self.values(location=location, imt=imt, realization=irlz).vals
+            self._data.put_derived(key, values)
+        return values
+
+    def aggregate(self, location, imt, quantiles):
+        """
+        weighted quantiles of the realizations at each level of the hazard curve for a location and imt.
+        Results are memoized in the curve cache so repeated calls (e.g. one per quantile of a fan plot) only
+        compute the quantiles not seen before.
+
+        :param quantiles: a quantile in [0, 1] or 'mean', or a list of them
+        :return: array [level] for a single quantile, otherwise [quantile, level]
+        """
+
+        single = isinstance(quantiles, str) or np.ndim(quantiles) == 0
+        quantiles = [quantiles] if single else list(quantiles)
+        quantiles = [q if isinstance(q, str) else float(q) for q in quantiles]
+
+        found = {q: self._data.get_derived(('aggregate', location, imt, q)) for q in dict.fromkeys(quantiles)}
+        missing = [q for q, values in found.items() if values is None]
+        if missing:
+            agg_values = weighted_quantiles(self.rlz_values(location, imt), missing, sample_weight=self.rlz_weights)
+            for i, q in enumerate(missing):
+                found[q] = np.ascontiguousarray(agg_values[:, i])
+                self._data.put_derived(('aggregate', location, imt, q), found[q])
+
+        agg_values = np.array([found[q] for q in quantiles])
+        return agg_values[0] if single else agg_values
+
     def get_hazard_metadata(self):
         q = query.get_hazard_metadata([self._hazard_id])
         return next(q)
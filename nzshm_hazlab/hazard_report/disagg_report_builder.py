@@ -1,3 +1,7 @@
+import re
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 from pathlib import Path, PurePath
 
@@ -16,7 +20,7 @@ HEAD_HTML = '''
 <head>
 <title>##TITLE##</title>
 <meta name="viewport" content="width=device-width, initial-scale=1">
-<link rel="stylesheet" href="disagg_report.css">
+<link rel="stylesheet" href="##CSS_HREF##">
 <style>
     .markdown-body {
         box-sizing: border-box;
@@ -44,9 +48,14 @@ TAIL_HTML = '''
 '''
 
 
+CSS_FILENAME = 'disagg_report.css'
+
+DisaggJob = namedtuple('DisaggJob', 'name shaking_level disagg bins')
+
+
 class DisaggReportBuilder:
 
-    def __init__(self, name, shaking_level, disagg_data, bins, output_path):
+    def __init__(self, name, shaking_level, disagg_data, bins, output_path, data_formats=('csv',), css_href=None):
 
         self._name = name
         self._output_path = Path(output_path)
@@ -55,6 +64,13 @@ class DisaggReportBuilder:
         self._disagg = disagg_data
         self._bins = bins
 
+        for data_format in data_formats:
+            if data_format not in ddf.DISAGG_WRITERS:
+                raise Exception(f'data format {data_format} is not one of {list(ddf.DISAGG_WRITERS.keys())}')
+        self._data_formats = data_formats
+        # a stylesheet shared with other reports, otherwise one is written next to the report
+        self._css_href = css_href
+
         if self._output_path.exists() and (not self._output_path.is_dir()):
             raise Exception(f'output path {self._output_path} is not a directory')
         
@@ -99,8 +115,9 @@ class DisaggReportBuilder:
                 bin_edges.append( b - bin_edges[-1] + b )
             header += f'{k} bin edges = {bin_edges} '
 
-        csv_filepath = Path(self._data_dir, 'disagg.csv')
-        ddf.disagg_to_csv(self._disagg, self._bins, header, csv_filepath)
+        for data_format in self._data_formats:
+            filepath = Path(self._data_dir, f'disagg.{data_format}')
+            ddf.DISAGG_WRITERS[data_format](self._disagg, self._bins, header, filepath)
 
     
     def generate_mode_table(self, dimensions):
@@ -328,14 +345,15 @@ class DisaggReportBuilder:
         # html = markdown.markdown(md_string, extensions=[TocExtension(toc_depth="2-4"),'tables'])
         html = markdown.markdown(md_string,extensions=['tables'])
 
-        head_html = HEAD_HTML.replace('##TITLE##',self._name)
+        head_html = HEAD_HTML.replace('##TITLE##',self._name).replace('##CSS_HREF##',self._css_href or CSS_FILENAME)
         html = head_html + html + TAIL_HTML        
         
         with open(PurePath(self._output_path, 'index.html'),'w') as output_file:
             output_file.write(html)
 
-        with open(PurePath(self._output_path, 'disagg_report.css'),'w') as output_file:
-            output_file.write(css_file)
+        if not self._css_href:
+            with open(PurePath(self._output_path, CSS_FILENAME),'w') as output_file:
+                output_file.write(css_file)
 
         print('done generating report')
 
@@ -387,3 +405,88 @@ class DisaggReportBuilder:
         table_md += '\n'
 
         return table_md        
+
+
+def _report_dirname(name, shaking_level):
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', f'{name}_{shaking_level:.2e}g').strip('_')
+
+
+def _use_agg_backend():
+    plt.switch_backend('Agg')
+
+
+def _build_report(job, report_path, data_formats, css_href):
+    DisaggReportBuilder(
+        job.name, job.shaking_level, job.disagg, job.bins, report_path, data_formats=data_formats, css_href=css_href
+    ).run()
+    return report_path
+
+
+def build_disagg_reports(jobs, output_path, n_workers=None, data_formats=('csv',), title='Disaggregation Reports'):
+    '''
+    build a DisaggReportBuilder report for each disaggregation, each in its own directory under output_path.
+    The reports share one stylesheet and are linked from an index page (output_path/index.html).
+
+    :param jobs: iterable of DisaggJob(name, shaking_level, disagg, bins)
+    :param output_path: directory for the reports
+    :param n_workers: number of processes to build the reports with (None or 1 to build them in this process).
+        The workers render with the non-interactive Agg backend.
+    :param data_formats: formats of the data files written with each report
+    :param title: title of the index page
+
+    :return: list of the report directories in the order of jobs
+    '''
+
+    output_path = Path(output_path)
+    if output_path.exists() and (not output_path.is_dir()):
+        raise Exception(f'output path {output_path} is not a directory')
+    output_path.mkdir(parents=True, exist_ok=True)
+
+    with open(Path(output_path, CSS_FILENAME), 'w') as output_file:
+        output_file.write(css_file)
+
+    jobs = [DisaggJob(*job) for job in jobs]
+    dirnames = []
+    for job in jobs:
+        dirname = base_dirname = _report_dirname(job.name, job.shaking_level)
+        suffix = 1
+        while dirname in dirnames:
+            dirname = f'{base_dirname}_{suffix}'
+            suffix += 1
+        dirnames.append(dirname)
+    report_paths = [Path(output_path, dirname) for dirname in dirnames]
+    css_href = f'../{CSS_FILENAME}'
+
+    if not n_workers or n_workers <= 1:
+        for job, report_path in zip(jobs, report_paths):
+            _build_report(job, report_path, data_formats, css_href)
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_use_agg_backend) as executor:
+            futures = [
+                executor.submit(_build_report, job, report_path, data_formats, css_href)
+                for job, report_path in zip(jobs, report_paths)
+            ]
+            for future in futures:
+                future.result()
+
+    generate_index(output_path, jobs, dirnames, title)
+
+    return report_paths
+
+
+def generate_index(output_path, jobs, dirnames, title='Disaggregation Reports'):
+    '''
+    index page linking to the report in each directory
+    '''
+
+    md_string = f'# {title}\n\n'
+    md_string += '| Name | Ground Motion | Report |\n'
+    md_string += '| ---- | ---- | ---- |\n'
+    for job, dirname in zip(jobs, dirnames):
+        md_string += f'| {job.name} | {job.shaking_level:.2e}g | <a href="{dirname}/index.html">report</a> |\n'
+
+    html = markdown.markdown(md_string, extensions=['tables'])
+    head_html = HEAD_HTML.replace('##TITLE##', title).replace('##CSS_HREF##', CSS_FILENAME)
+
+    with open(PurePath(output_path, 'index.html'), 'w') as output_file:
+        output_file.write(head_html + html + TAIL_HTML)
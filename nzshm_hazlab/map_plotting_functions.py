@@ -21,9 +21,9 @@ def clear_cpt():
         CPT_FILEPATH.unlink()
 
 
-def get_poe_grid(hazard_id, vs30, imt, agg, poe):
+def get_poe_grid(hazard_id, vs30, imt, agg, poe, cache=None):
 
-    haz_poe = get_hazard_at_poe(hazard_id, vs30, imt, agg, poe)
+    haz_poe = get_hazard_at_poe(hazard_id, vs30, imt, agg, poe, cache=cache)
     haz_poe = haz_poe.pivot(index="lat", columns="lon")
     haz_poe = haz_poe.droplevel(0, axis=1)
     return xr.DataArray(data=haz_poe)
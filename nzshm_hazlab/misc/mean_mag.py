@@ -1,5 +1,4 @@
-
-from nzshm_hazlab.disagg_data_functions import prob_to_rate
+from nzshm_hazlab.disagg_data_functions import calc_disagg_stats
 from toshi_hazard_store import model, query
 from nzshm_common.location.code_location import CodedLocation
 import numpy as np
@@ -12,15 +11,26 @@ def lat_lon(id):
 all_locations = [CodedLocation(*lat_lon(id), 0.001) for id in LOCATION_LISTS['SRWG214']['locations']]
 all_clocations = [loc.code for loc in all_locations]
 
+location_ids = {}
+for code, id in zip(all_clocations, LOCATION_LISTS['SRWG214']['locations']):
+    location_ids.setdefault(code, id)
+
 def get_mean_mag(disaggs, bins):
-    disaggs = prob_to_rate(disaggs)
-    return np.sum( disaggs / np.sum(disaggs) * bins[0] )
+    return float(get_mean_mag_stack(np.asarray(disaggs)[None], bins)[0])
+
+
+def get_mean_mag_stack(disaggs, bins):
+    '''
+    mean magnitude of a stack of disaggregations [n, mag, dist, trt, eps] sharing the same bins, in one pass
+    '''
+
+    return calc_disagg_stats(disaggs, bins).means['mag']
 
 
 def get_mean_mags(hazard_id, locations, vs30s, imts, poes, hazard_agg):
 
     clocs = [loc.code for loc in locations]
-    disaggs = query.get_disagg_aggregates(
+    disaggs = list(query.get_disagg_aggregates(
         hazard_model_ids=[hazard_id],
         disagg_aggs = [model.AggregationEnum.MEAN],
         hazard_aggs = [hazard_agg],
@@ -28,11 +38,21 @@ def get_mean_mags(hazard_id, locations, vs30s, imts, poes, hazard_agg):
         vs30s = vs30s,
         imts = imts,
         probabilities = poes,
-    )
-    for disagg in disaggs:
-        mean_mag = get_mean_mag(disagg.disaggs, disagg.bins)
-        if disagg.nloc_001 in all_clocations:
-            id = LOCATION_LISTS['SRWG214']['locations'][all_clocations.index(disagg.nloc_001)]
+    ))
+
+    # disaggs with the same shape and magnitude bins are reduced together
+    groups = {}
+    for i, disagg in enumerate(disaggs):
+        key = (np.shape(disagg.disaggs), tuple(np.asarray(disagg.bins[0]).tolist()))
+        groups.setdefault(key, []).append(i)
+    mean_mags = np.empty(len(disaggs))
+    for idx in groups.values():
+        stack = np.stack([disaggs[i].disaggs for i in idx])
+        mean_mags[idx] = get_mean_mag_stack(stack, disaggs[idx[0]].bins)
+
+    for disagg, mean_mag in zip(disaggs, mean_mags):
+        if disagg.nloc_001 in location_ids:
+            id = location_ids[disagg.nloc_001]
             name = location_by_id(id)['name']
         else:
             id = disagg.nloc_001
@@ -46,6 +66,6 @@ def get_mean_mags(hazard_id, locations, vs30s, imts, poes, hazard_agg):
             poe = disagg.probability.name.split('_')[1],
             imt = disagg.imt,
             imtl = f"{disagg.shaking_level:0.2e}",
-            mag = mean_mag,
+            mag = float(mean_mag),
         )
         yield d
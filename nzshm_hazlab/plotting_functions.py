@@ -4,11 +4,13 @@ from pandas import DataFrame
 from matplotlib.pylab import Axes, Line2D
 from typing import List, Dict
 from nzshm_common.location import CodedLocation
-from nzshm_hazlab.base_functions import period_from_imt, imt_from_period
+from nzshm_hazlab.base_functions import period_from_imt, imt_from_period, as_array
+from nzshm_hazlab.hazard_cube import HazardCube
 from nzshm_hazlab.data_functions import ( 
 
-    # calculate_agg,
+    calculate_agg,
     compute_hazard_at_poe,
+    compute_hazard_at_poes,
     rp_from_poe,
     poe_from_rp,
     rp_from_poe
@@ -28,6 +30,9 @@ def extract_hazard_curve(
         imt: str,
         agg: str,
 ):
+    if isinstance(hazard_data, HazardCube):
+        return hazard_data.curve(location, imt, agg)
+
     lat, lon = location.code.split('~')
 
     hd_filt = hazard_data.loc[
@@ -149,15 +154,14 @@ def plot_hazard_curve_wunc(hazard_data, location, imt, ax, xlim, ylim, bandw=Fal
                         upper2 = 0.95,
                         lower2 = 0.05,
                         )
-        values = {}
-        for k,quant in quantiles.items():
-            values[k] = calculate_agg(hazard_data,location,imt,quant)
+        values = dict(zip(quantiles.keys(), hazard_data.aggregate(location, imt, list(quantiles.values()))))
         ax.fill_between(lvls, values['upper1'], values['lower1'],alpha = 0.5, color='b')
         ax.plot(lvls, values['upper2'],color='b',lw=1)
         ax.plot(lvls, values['lower2'],color='b',lw=1)
     else:
         da = 0.01
         aggs = np.arange(0,1.0+da,da)
+        fan = hazard_data.aggregate(location, imt, aggs)
         for i,agg in enumerate(aggs):
             # alpha = min(1.0,(len(aggs)/2.0 - np.abs(len(aggs)/2.0 - i)) / (len(aggs)/2.0)+0.25)
             # alpha = min(1.0,-(2.0/len(aggs))**2 * (i-len(aggs)/2.0)**2  + 1.2)
@@ -166,7 +170,7 @@ def plot_hazard_curve_wunc(hazard_data, location, imt, ax, xlim, ylim, bandw=Fal
             # alpha = (len(aggs)/2.0 + np.abs(len(aggs)/2.0 - i)) / (len(aggs)/2.0) - 1.0
             alpha = max(0.5,(len(aggs)/2.0 + np.abs(len(aggs)/2.0 - i)) / (len(aggs)/2.0) - 1.0)
             print(alpha)
-            vals = calculate_agg(hazard_data,location,imt,agg)
+            vals = fan[i]
             # ax.plot(lvls,vals,color=str(alpha),alpha=0.6,lw=1)
             ax.plot(lvls,vals,color=str(alpha),lw=1)
                     
@@ -182,10 +186,7 @@ def plot_hazard_curve_wunc(hazard_data, location, imt, ax, xlim, ylim, bandw=Fal
 
         da = 0.02
         aggs = np.arange(0.01,0.99,da)
-        haz_poe = [] #acceleration
-        for i,agg in enumerate(aggs):
-            vals = calculate_agg(hazard_data,location,imt,agg)
-            haz_poe.append(compute_hazard_at_poe(lvls,vals,poe,inv_time))
+        haz_poe = compute_hazard_at_poe(lvls, hazard_data.aggregate(location, imt, aggs), poe, inv_time) #acceleration
         pdf = []
         for i in range(1,len(aggs)-1):
             pdf.append( (aggs[i+1] - aggs[i-1])/(2*(haz_poe[i+1]-haz_poe[i-1])) )
@@ -194,10 +195,7 @@ def plot_hazard_curve_wunc(hazard_data, location, imt, ax, xlim, ylim, bandw=Fal
         
         da = 0.02
         aggs = np.arange(0.2-da,0.8+da,da)
-        haz_poe = [] #acceleration
-        for i,agg in enumerate(aggs):
-            vals = calculate_agg(hazard_data,location,imt,agg)
-            haz_poe.append(compute_hazard_at_poe(lvls,vals,poe,inv_time))
+        haz_poe = compute_hazard_at_poe(lvls, hazard_data.aggregate(location, imt, aggs), poe, inv_time) #acceleration
         pdf = []
         for i in range(1,len(aggs)-1):
             pdf.append( (aggs[i+1] - aggs[i-1])/(2*(haz_poe[i+1]-haz_poe[i-1])) )
@@ -231,6 +229,9 @@ def plot_spectrum(
 ):
     #TODO: this is slow!
 
+    if isinstance(hazard_data, HazardCube):
+        return _plot_spectrum_cube(hazard_data, location, poe, inv_time, ax, central, bandw, color)
+
     lat, lon = location.split('~')
 
     hd_filt = hazard_data.loc[ (hazard_data['lat'] == lat) & (hazard_data['lon'] == lon)]
@@ -307,8 +308,56 @@ def plot_spectrum(
     return lh
 
 
+def _plot_spectrum_cube(
+        hazard_cube: HazardCube,
+        location: str,
+        poe: float,
+        inv_time: float,
+        ax: Axes,
+        central: str='mean',
+        bandw: bool=False,
+        color: str='b'
+):
+
+    periods = [period_from_imt(imt) for imt in hazard_cube.imts]
+    imt_order = np.argsort(periods)
+    periods = [periods[i] for i in imt_order]
+    levels = hazard_cube.levels[imt_order]
+    i_loc = hazard_cube.loc_idx(location)
+
+    def spectrum(agg):
+        values = hazard_cube.values[i_loc, imt_order, hazard_cube.agg_index[agg]]
+        return compute_hazard_at_poes(levels, values, [poe], inv_time)[:, 0]
+
+    if bandw:
+        quantiles = dict(
+                        upper1 = 0.9,
+                        lower1 = 0.1,
+                        upper2 = 0.975,
+                        lower2 = 0.025,
+                        )
+        hazard = {k: spectrum(str(quant)) for k, quant in quantiles.items()}
+        ax.fill_between(periods,hazard['upper1'],hazard['lower1'],alpha = 0.5, color=color)
+        ax.plot(periods, hazard['upper2'],color=color,lw=1)
+        ax.plot(periods, hazard['lower2'],color=color,lw=1)
+
+    lh = ax.plot(periods, spectrum(central), color=color, alpha=0.8,lw=2)
+    lh = lh[0]
+
+    xlim = [0, max(periods)]
+    ylim = ax.get_ylim()
+    ylim = [0, ylim[1]]
+    _ = ax.set_ylim(ylim)
+    _ = ax.set_xlim(xlim)
+    _ = ax.set_xlabel('Period [s]', fontsize=AXIS_FONTSIZE)
+    _ = ax.set_ylabel('Shaking Intensity [g]', fontsize=AXIS_FONTSIZE)
+    _ = ax.tick_params(axis='both', which='major', labelsize=TICK_FONTSIZE)
+    _ = ax.grid(color='lightgray')
+
+    return lh
+
+
 def plot_spectrum_wunc(hazard_data, location, poe, inv_time, ax, bandw=False):
-    #TODO: this is slow!
 
     periods = [period_from_imt(imt) for imt in hazard_data.imts]
     periods.sort()
@@ -323,28 +372,23 @@ def plot_spectrum_wunc(hazard_data, location, poe, inv_time, ax, bandw=False):
                         upper2 = 0.95,
                         lower2 = 0.05,
                         )
-        hazard = {}
-        for k,quant in quantiles.items():
-            haz = []
-            for imt in imts:
-                vals = calculate_agg(hazard_data,location,imt,quant)
-                haz.append(compute_hazard_at_poe(lvls,vals,poe,inv_time))
-            hazard[k] = haz
+        # [imt, quantile]
+        haz = compute_hazard_at_poe(lvls, np.array([hazard_data.aggregate(location, imt, list(quantiles.values())) for imt in imts]), poe, inv_time)
+        hazard = {k: haz[:, i] for i, k in enumerate(quantiles.keys())}
         ax.fill_between(periods,hazard['upper1'],hazard['lower1'],alpha = 0.5, color='b')
         ax.plot(periods, hazard['upper2'],color='b',lw=1)
         ax.plot(periods, hazard['lower2'],color='b',lw=1)
     else:
         da = 0.01
         aggs = np.arange(0,1.0+da,da)
+        # [imt, quantile]
+        fan = compute_hazard_at_poe(lvls, np.array([hazard_data.aggregate(location, imt, aggs) for imt in imts]), poe, inv_time)
         for i,agg in enumerate(aggs):
             # alpha = min(1.0,(len(aggs)/2.0 - np.abs(len(aggs)/2.0 - i)) / (len(aggs)/2.0)+0.25)
             # alpha = min(1.0,-(2.0/len(aggs))**2 * (i-len(aggs)/2.0)**2  + 1.2)
             # alpha = max(0.0,(len(aggs)/2.0 - np.abs(len(aggs)/2.0 - i)) / (len(aggs)/2.0)-0.1)
             alpha = max(0.0,(len(aggs)/2.0 - np.abs(len(aggs)/2.0 - i)) / (len(aggs)/2.0))
-            hazard = []
-            for imt in imts:
-                vals = calculate_agg(hazard_data,location,imt,agg)
-                hazard.append(compute_hazard_at_poe(lvls,vals,poe,inv_time))
+            hazard = fan[:, i]
             ax.plot(periods,hazard,color=str(alpha),alpha=0.6,lw=1)
 
 
@@ -373,14 +417,14 @@ def plot_rfactor_curve(ax,site_list,imt,ref_rps,xlim,ylim,results,mean=False,med
     r_rp = 500
     
     imtls = results['metadata'][f'{intensity_type}_imtls']
-    hcurves_rlzs = np.array(results['hcurves']['hcurves_rlzs'])
-    hcurves_stats = np.array(results['hcurves']['hcurves_stats'])
+    hcurves_rlzs = as_array(results['hcurves']['hcurves_rlzs'])
+    hcurves_stats = as_array(results['hcurves']['hcurves_stats'])
     sites = pd.DataFrame(results['metadata']['sites'])
     quantiles = results['metadata']['quantiles']
     
     hazard_rps = np.array(results['hazard_design']['hazard_rps'])
-    im_hazard = np.array(results['hazard_design'][intensity_type]['im_hazard'])
-    stats_im_hazard = np.array(results['hazard_design'][intensity_type]['stats_im_hazard'])
+    im_hazard = as_array(results['hazard_design'][intensity_type]['im_hazard'])
+    stats_im_hazard = as_array(results['hazard_design'][intensity_type]['stats_im_hazard'])
     
     imt_idx = list(imtls.keys()).index(imt)
     rp_idx = np.where(hazard_rps==r_rp)[0]
@@ -536,8 +580,8 @@ def retrieve_design_intensities(results,intensity_type,design_type,imt,rp=500):
 
     if design_type == 'hazard_design':
         im_idx = results[design_type]['hazard_rps'].index(rp)
-        im_values_rlzs = np.squeeze(np.array(results[design_type][intensity_type]['im_hazard'])[:,imt_idx,im_idx,:,0])
-        im_values_stats = np.squeeze(np.array(results[design_type][intensity_type]['stats_im_hazard'])[:,imt_idx,im_idx,:])
+        im_values_rlzs = np.squeeze(as_array(results[design_type][intensity_type]['im_hazard'])[:,imt_idx,im_idx,:,0])
+        im_values_stats = np.squeeze(as_array(results[design_type][intensity_type]['stats_im_hazard'])[:,imt_idx,im_idx,:])
         
     return im_values_rlzs, im_values_stats
 
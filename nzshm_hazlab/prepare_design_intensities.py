@@ -1,116 +1,314 @@
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from statistics import NormalDist
+
 from nzshm_hazlab.base_functions import *
+from nzshm_hazlab.data_functions import interp_loglog_inverse
 
-def calculate_hazard_design_intensities(data,hazard_rps,intensity_type='acc'):
+def calculate_hazard_design_intensities(data,hazard_rps,intensity_type='acc',n_workers=None):
     '''
     calculate design intensities based on an annual probability of exceedance (APoE)
 
     :param data: dictionary containing hazard curves and metadata for sites, intensity measures, and rlz weights
     :param hazard_rps: np array containing the desired return periods (1 / APoE)
+    :param n_workers: number of processes to share the sites between (None or 1 to run in this process)
 
     :return: np arrays for all intensities from the hazard curve realizations and stats (mean and quantiles)
     '''
     
-    imtls = data['metadata'][f'{intensity_type}_imtls']    
-    rlz_weights = np.array(data['metadata']['rlz_weights'])
-    hcurves_rlzs = np.array(data['hcurves']['hcurves_rlzs'])
-    hcurves_stats   = np.array(data['hcurves']['hcurves_stats'])
-    
+    imtls = data['metadata'][f'{intensity_type}_imtls']
+    rlz_weights = np.asarray(data['metadata']['rlz_weights'])
+    hcurves_rlzs = np.asarray(data['hcurves']['hcurves_rlzs'])
+    hcurves_stats = np.asarray(data['hcurves']['hcurves_stats'])
+
+    apoes = 1 / np.asarray(hazard_rps, dtype=float)
+    levels = np.array([imtls[imt] for imt in imtls.keys()], dtype=float)
+
+    return map_site_shards(hazard_design_block, [hcurves_rlzs, hcurves_stats], (levels, apoes, rlz_weights), n_workers)
+
+
+def hazard_design_block(hcurves_rlzs, hcurves_stats, levels, apoes, rlz_weights):
+    '''
+    design intensities at the APoEs for a block of sites
+
+    :param hcurves_rlzs: hazard curves [site, imt, imtl, rlz]
+    :param hcurves_stats: hazard curves [site, imt, imtl, stat]
+    :param levels: intensity measure levels [imt, imtl]
+    :param apoes: annual probabilities of exceedance [rp]
+    :param rlz_weights: realization weights [rlz]
+
+    :return: im_hazard [site, imt, rp, rlz, 2] and stats_im_hazard [site, imt, rp, stat]
+    '''
+
     [n_sites,n_imts,n_imtls,n_rlz] = hcurves_rlzs.shape
-    [_,_,_,n_stats] = hcurves_stats.shape
-    
-    n_rps = len(hazard_rps)
-    
+    n_rps = len(apoes)
+    # [imt, 1, imtl] to broadcast over the curves moved to [site, imt, rlz or stat, imtl]
+    levels = levels[:, None, :]
+
     im_hazard = np.zeros([n_sites,n_imts,n_rps,n_rlz,2])
-    stats_im_hazard = np.zeros([n_sites,n_imts,n_rps,n_stats])
-    
-    for i_site in range(n_sites):
-        for i_imt,imt in enumerate(imtls.keys()):
-            for i_rlz in range(n_rlz):
-                # logspace interpolation at the APoE for each return period
-                im_hazard[i_site,i_imt,:,i_rlz,0] = np.exp(np.interp(np.log(1/hazard_rps), np.log(np.flip(hcurves_rlzs[i_site,i_imt,:,i_rlz])), np.log(np.flip(imtls[imt]))))
 
-            # record the position of the realizations in the cdf of the full distribution
-            for i_rp,rp in enumerate(hazard_rps):
-                # order the metric to find the quantiles
-                cdf_idx = np.argsort(np.squeeze(im_hazard[i_site,i_imt,i_rp,:,0]))
-                im_idx = np.argsort(cdf_idx)
-                cdf = np.cumsum(rlz_weights[cdf_idx])
-                im_hazard[i_site,i_imt,i_rp,:,1] = cdf[im_idx]
-
-            # loop over the median and any quantiles
-            for i_stat in range(n_stats):
-                stats_im_hazard[i_site,i_imt,:,i_stat] = np.exp(np.interp(np.log(1/hazard_rps), np.log(np.flip(hcurves_stats[i_site,i_imt,:,i_stat])), np.log(np.flip(imtls[imt]))))
-                
+    # logspace interpolation at the APoE for each return period, [site, imt, rlz, rp]
+    im_rlzs = interp_loglog_inverse(levels, np.moveaxis(hcurves_rlzs, 3, 2), apoes)
+    im_hazard[..., 0] = np.moveaxis(im_rlzs, 3, 2)
+
+    # record the position of the realizations in the cdf of the full distribution
+    im_hazard[..., 1] = weighted_cdf_position(im_hazard[..., 0], rlz_weights)
+
+    # the median and any quantiles
+    im_stats = interp_loglog_inverse(levels, np.moveaxis(hcurves_stats, 3, 2), apoes)
+    stats_im_hazard = np.moveaxis(im_stats, 3, 2)
+
     return im_hazard, stats_im_hazard
 
 
-def calculate_risk_design_intensities(data,risk_assumptions,imtl_list):
+def calculate_risk_design_intensities(data,risk_assumptions,imtl_list,n_workers=None):
     '''
     calculate design intensities based on a risk target and fragility assumptions
 
     :param data: dictionary containing hazard curves and metadata for sites, intensity measures, and rlz weights
     :param risk_target_assumptions: dictionary with keys for combinations of assumptions
     :param imtl_list: a list of intensity measures to include (must be included in the available imtls)
+    :param n_workers: number of processes to share the sites between (None or 1 to run in this process)
 
     :return: np arrays for all intensities from the hazard curve realizations and stats (mean and quantiles)
     '''
 
     intensity_type = 'acc'
     imtls = data['metadata'][f'{intensity_type}_imtls']
-    rlz_weights = np.array(data['metadata']['rlz_weights'])
-    hcurves_rlzs = np.array(data['hcurves']['hcurves_rlzs'])
-    hcurves_stats = np.array(data['hcurves']['hcurves_stats'])
+    rlz_weights = np.asarray(data['metadata']['rlz_weights'])
+    hcurves_rlzs = np.asarray(data['hcurves']['hcurves_rlzs'])
+    hcurves_stats = np.asarray(data['hcurves']['hcurves_stats'])
+
+    imts = []
+    for imt in imtl_list:
+        print(f'Processing {imt}.')
+        imts.append((list(imtls.keys()).index(imt), np.asarray(imtls[imt], dtype=float)))
+
+    assumptions = [(ra['risk_target'], ra['beta'], ra['design_point']) for ra in risk_assumptions.values()]
+
+    [im_risk, lambda_risk, fragility_risk, stats_im_risk, stats_lambda_risk, stats_fragility_risk] = map_site_shards(
+        risk_design_block, [hcurves_rlzs, hcurves_stats], (imts, assumptions, rlz_weights), n_workers)
+
+    # store results as a dictionary
+    im_risk = {'im_risk':im_risk,'lambda_risk':lambda_risk,'fragility_risk':fragility_risk}
+    stats_im_risk = {'stats_im_risk':stats_im_risk,'stats_lambda_risk':stats_lambda_risk,'stats_fragility_risk':stats_fragility_risk}
+    return im_risk, stats_im_risk
+
+
+def risk_design_block(hcurves_rlzs, hcurves_stats, imts, assumptions, rlz_weights):
+    '''
+    risk targeted design intensities for a block of sites
+
+    :param hcurves_rlzs: hazard curves [site, imt, imtl, rlz]
+    :param hcurves_stats: hazard curves [site, imt, imtl, stat]
+    :param imts: list of (imt index, intensity measure levels) to include
+    :param assumptions: list of (risk_target, beta, design_point) for each risk assumption
+    :param rlz_weights: realization weights [rlz]
+
+    :return: im_risk, lambda_risk, fragility_risk, stats_im_risk, stats_lambda_risk, stats_fragility_risk
+    '''
 
     [n_sites, n_imts, n_imtls, n_rlz] = hcurves_rlzs.shape
     [_, _, _, n_stats] = hcurves_stats.shape
-    
-    n_risk_assumptions = len(risk_assumptions.keys())
-    
+
+    n_risk_assumptions = len(assumptions)
+
     im_risk = np.zeros([n_sites,n_imts,n_risk_assumptions,n_rlz,2])
     lambda_risk = np.zeros([n_sites,n_imts,n_risk_assumptions,n_rlz])
     fragility_risk = np.zeros_like(lambda_risk)
-    
+
     stats_im_risk = np.zeros([n_sites,n_imts,n_risk_assumptions,n_stats])
     stats_lambda_risk = np.zeros_like(stats_im_risk)
     stats_fragility_risk = np.zeros_like(stats_im_risk)
-    
-    
-    for imt in imtl_list:
-        print(f'Processing {imt}.')
-        i_imt = list(imtls.keys()).index(imt)
-        for i_site in range(n_sites):
-            # loop over the risk target assumption dictionaries
-            for i_rt,rt in enumerate(risk_assumptions.keys()):
-                risk_target = risk_assumptions[rt]['risk_target']
-                beta = risk_assumptions[rt]['beta']
-                conditional_prob = risk_assumptions[rt]['design_point']
-
-                # optimize the design intensity for the risk target for each realization
-                for i_rlz in range(n_rlz):
-                    [im_r,median] = find_uniform_risk_intensity(hcurves_rlzs[i_site,i_imt,:,i_rlz], imtls[imt], beta, risk_target, conditional_prob)
-                    im_risk[i_site,i_imt,i_rt,i_rlz,0] = im_r
-                    lambda_risk[i_site,i_imt,i_rt,i_rlz] = np.interp(im_r, imtls[imt], hcurves_rlzs[i_site,i_imt,:,i_rlz])
-                    fragility_risk[i_site,i_imt,i_rt,i_rlz] = median
-
-                # record the position of the realizations in the cdf of the full distribution
-                # order the metric to find the quantiles
-                cdf_idx = np.argsort(np.squeeze(im_risk[i_site,i_imt,i_rt,:,0]))
-                im_idx = np.argsort(cdf_idx)
-                cdf = np.cumsum(rlz_weights[cdf_idx])
-                im_risk[i_site,i_imt,i_rt,:,1] = cdf[im_idx]
-
-                # loop over the median and any quantiles
-                for i_stat in range(n_stats):
-                    [im_r,median] = find_uniform_risk_intensity(hcurves_stats[i_site,i_imt,:,i_stat], imtls[imt], beta, risk_target, conditional_prob)
-                    stats_im_risk[i_site,i_imt,i_rt,i_stat] = im_r
-                    stats_lambda_risk[i_site,i_imt,i_rt,i_stat] = np.interp(im_r, imtls[imt], hcurves_stats[i_site,i_imt,:,i_stat])
-                    stats_fragility_risk[i_site,i_imt,i_rt,i_stat] = median
 
-    # store results as a dictionary
-    im_risk = {'im_risk':im_risk.tolist(),'lambda_risk':lambda_risk.tolist(),'fragility_risk':fragility_risk.tolist()}
-    stats_im_risk = {'stats_im_risk':stats_im_risk.tolist(),'stats_lambda_risk':stats_lambda_risk.tolist(),'stats_fragility_risk':stats_fragility_risk.tolist()}
-    return im_risk, stats_im_risk
+    for i_imt, imtl in imts:
+        # [site, rlz or stat, imtl]
+        curves_rlzs = np.moveaxis(hcurves_rlzs[:, i_imt], 1, -1)
+        curves_stats = np.moveaxis(hcurves_stats[:, i_imt], 1, -1)
+
+        # loop over the risk target assumptions
+        for i_rt, (risk_target, beta, conditional_prob) in enumerate(assumptions):
+
+            # solve for the design intensity for the risk target for all sites and realizations at once
+            [im_r, median] = find_uniform_risk_intensities(curves_rlzs, imtl, beta, risk_target, conditional_prob)
+            im_risk[:,i_imt,i_rt,:,0] = im_r
+            lambda_risk[:,i_imt,i_rt,:] = interp_rows(im_r, imtl, curves_rlzs)
+            fragility_risk[:,i_imt,i_rt,:] = median
+
+            # record the position of the realizations in the cdf of the full distribution
+            im_risk[:,i_imt,i_rt,:,1] = weighted_cdf_position(im_r, rlz_weights)
+
+            # the median and any quantiles
+            [im_r, median] = find_uniform_risk_intensities(curves_stats, imtl, beta, risk_target, conditional_prob)
+            stats_im_risk[:,i_imt,i_rt,:] = im_r
+            stats_lambda_risk[:,i_imt,i_rt,:] = interp_rows(im_r, imtl, curves_stats)
+            stats_fragility_risk[:,i_imt,i_rt,:] = median
+
+    return im_risk, lambda_risk, fragility_risk, stats_im_risk, stats_lambda_risk, stats_fragility_risk
+
+
+def map_site_shards(block_fn, arrays, args=(), n_workers=None):
+    '''
+    apply block_fn(*arrays, *args) with the arrays split along the site (first) axis between processes
+
+    The arrays are copied once into shared memory and each worker reads its shard from there rather
+    than receiving a pickled copy. Every output of block_fn must have sites along its first axis; the
+    shards are concatenated back in site order. The computation for each site does not depend on the
+    other sites, so the output is identical to the serial result.
+
+    :param block_fn: top level function returning a tuple of arrays
+    :param arrays: list of arrays with sites along the first axis
+    :param args: further (small) arguments passed to every call
+    :param n_workers: number of processes (None or 1 to call block_fn in this process)
+
+    :return: tuple of arrays for all sites
+    '''
+
+    n_sites = arrays[0].shape[0]
+    if not n_workers or n_workers <= 1 or n_sites <= 1:
+        return block_fn(*arrays, *args)
+
+    n_shards = min(n_workers, n_sites)
+    bounds = np.linspace(0, n_sites, n_shards + 1).astype(int)
+
+    shms = []
+    try:
+        specs = []
+        for array in arrays:
+            array = np.ascontiguousarray(array)
+            shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            shms.append(shm)
+            np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+            specs.append((shm.name, array.shape, array.dtype.str))
+
+        with ProcessPoolExecutor(max_workers=n_shards) as executor:
+            futures = [executor.submit(_site_shard, block_fn, specs, start, stop, args)
+                       for start, stop in zip(bounds[:-1], bounds[1:])]
+            results = [future.result() for future in futures]
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+
+    return tuple(np.concatenate(outputs, axis=0) for outputs in zip(*results))
+
+
+def _site_shard(block_fn, specs, start, stop, args):
+    shms = [shared_memory.SharedMemory(name=name) for name, _, _ in specs]
+    try:
+        # copy the shard out so no views of the shared buffers outlive this call
+        arrays = [np.ndarray(shape, dtype=dtype, buffer=shm.buf)[start:stop].copy()
+                  for shm, (_, shape, dtype) in zip(shms, specs)]
+        return block_fn(*arrays, *args)
+    finally:
+        for shm in shms:
+            shm.close()
+
+
+
+def weighted_cdf_position(values, weights):
+    '''
+    position of each value in the weighted cdf of its distribution along the last axis
+
+    :param values: array [..., n_rlz]
+    :param weights: realization weights [n_rlz]
+
+    :return: array [..., n_rlz] of cumulative weights at each value
+    '''
+
+    cdf_idx = np.argsort(values, axis=-1)
+    cdf = np.cumsum(np.asarray(weights)[cdf_idx], axis=-1)
+    position = np.empty_like(cdf)
+    np.put_along_axis(position, cdf_idx, cdf, axis=-1)
+    return position
+
+
+def trapz_weights(x):
+    '''
+    weights w such that np.sum(w * y) is the trapezoidal integral of y over x
+    '''
+
+    dx = np.diff(x)
+    weights = np.zeros(len(x))
+    weights[:-1] += dx / 2
+    weights[1:] += dx / 2
+    return weights
+
+
+def solve_risk_medians(hcurves, imtl, beta, target_risk, n_grid=64, n_iter=50):
+    '''
+    vectorized solution for the median of the lognormal fragility function that gives the target risk
+    for many hazard curves at once
+
+    The risk for a log median mu is sum_j(k_j * H_j * exp(-(ln(imtl_j) - mu)^2 / (2 beta^2))) where k holds
+    the lognormal pdf normalisation and trapezoidal integration weights on the imtl grid. The risk is
+    tabulated on a grid of log medians to bracket the largest median that meets the target for every curve,
+    and each bracket is then refined by bisection. Curves that contain NaN (e.g. missing sites) or are zero
+    everywhere have no solution and return NaN.
+
+    :param hcurves: hazard curves [..., n_imtl]
+    :param imtl:   intensity measure levels [n_imtl]
+    :param beta:   log std for the fragility function
+    :param target_risk:  risk value to target
+
+    :return: fragility medians [...]
+    '''
+
+    imtl = np.asarray(imtl, dtype=float)
+    log_imtl = np.log(imtl)
+    kernel = trapz_weights(imtl) / (imtl * beta * np.sqrt(2 * np.pi))
+    hcurves = np.asarray(hcurves, dtype=float)
+    invalid = ~np.all(np.isfinite(hcurves), axis=-1) | ~np.any(hcurves > 0, axis=-1)
+    weighted_hcurves = np.ascontiguousarray(np.where(invalid[..., None], 0.0, hcurves) * kernel)
+
+    def risk(log_median):
+        z = (log_imtl - log_median[..., None]) / beta
+        return np.sum(weighted_hcurves * np.exp(-0.5 * z * z), axis=-1)
+
+    batch_shape = weighted_hcurves.shape[:-1]
+    log_grid = np.linspace(log_imtl[0], log_imtl[-1] + 3 * beta, n_grid)
+
+    # the largest grid median with risk at or above the target, and the grid median of maximum risk
+    # for curves that never reach the target
+    i_above = np.full(batch_shape, -1)
+    i_max = np.zeros(batch_shape, dtype=int)
+    risk_max = np.full(batch_shape, -np.inf)
+    for i, log_median in enumerate(log_grid):
+        r = risk(np.full(batch_shape, log_median))
+        i_above = np.where(r >= target_risk, i, i_above)
+        i_max = np.where(r > risk_max, i, i_max)
+        risk_max = np.maximum(r, risk_max)
+
+    lo = log_grid[np.clip(i_above, 0, n_grid - 1)]
+    hi = log_grid[np.clip(i_above + 1, 0, n_grid - 1)]
+    for _ in range(n_iter):
+        mid = 0.5 * (lo + hi)
+        above = risk(mid) >= target_risk
+        lo = np.where(above, mid, lo)
+        hi = np.where(above, hi, mid)
+
+    log_median = 0.5 * (lo + hi)
+    log_median = np.where(i_above < 0, log_grid[i_max], log_median)
+    return np.where(invalid, np.nan, np.exp(log_median))
+
+
+def find_uniform_risk_intensities(hcurves, imtl, beta, target_risk, design_point):
+    '''
+    vectorized equivalent of find_uniform_risk_intensity for many hazard curves
 
+    :param hcurves: hazard curves [..., n_imtl]
+    :param imtl:   intensity measure levels [n_imtl]
+    :param beta:   log std for the fragility function
+    :param target_risk:   risk value to target
+    :param design_point:  design point for selecting the design intensity
+
+    :return: design intensities and medians of fragility, each [...] (NaN for NaN or all zero curves)
+    '''
+
+    median = solve_risk_medians(hcurves, imtl, beta, target_risk)
+    im_r = median * np.exp(beta * NormalDist().inv_cdf(design_point))
+
+    return im_r, median
 
 
 def risk_convolution_error(median, hcurve, imtl, beta, target_risk):
@@ -125,6 +323,7 @@ def risk_convolution_error(median, hcurve, imtl, beta, target_risk):
 
     :return: error from risk target
     '''
+    from scipy import stats
 
     pdf_limitstate_im = stats.lognorm(beta, scale=median).pdf(imtl)
     disaggregation = pdf_limitstate_im * hcurve
@@ -145,6 +344,8 @@ def find_uniform_risk_intensity(hcurve, imtl, beta, target_risk, design_point):
 
     :return: design intensity and median of fragility
     '''
+    from scipy import stats
+    from scipy.optimize import minimize
 
     x0 = 0.5
     median = minimize(risk_convolution_error, x0, args=(hcurve, imtl, beta, target_risk), method='Nelder-Mead').x[0]
@@ -164,6 +365,7 @@ def risk_convolution(hcurve, imtl, median, beta):
 
     :return: the total risk and the disagg curve
     '''
+    from scipy import stats
 
     pdf_limitstate_im = stats.lognorm(beta, scale=median).pdf(imtl)
     disaggregation = pdf_limitstate_im * hcurve
@@ -1,11 +1,63 @@
+from typing import Iterator, List, Optional
+
 import numpy as np
 import pandas as pd
 
 from nzshm_hazlab.read_oq_hdf5 import convert_imtls_to_disp, find_site_names
+from nzshm_hazlab.store.curves import HazardBatch
 from toshi_hazard_store import query
 from nzshm_common.location import location
 
 
+def iter_hazard_batches(
+        hazard_id: str,
+        kind: str = 'rlz',
+        locs: Optional[List[str]] = None,
+        imts: Optional[List[str]] = None,
+        batch_size: int = 1000,
+) -> Iterator[HazardBatch]:
+    '''
+    Streams realization (kind='rlz') or aggregate (kind='stats') curves from toshi-hazard-store as HazardBatch
+    blocks of at most batch_size curves (one per location, imt and realization or agg). For realizations the
+    aggs field holds the realization index. Reductions over realizations can consume the batches incrementally
+    without holding all realizations in memory.
+    '''
+
+    if kind == 'rlz':
+        res = query.get_hazard_rlz_curves_v2(hazard_id, imts, locs, None)
+    elif kind == 'stats':
+        res = query.get_hazard_stats_curves_v2(hazard_id, imts, locs, None)
+    else:
+        raise ValueError(f"kind must be 'rlz' or 'stats', not {kind}")
+
+    def empty_batch():
+        return dict(locations=[], imts=[], aggs=[], levels=[], apoe=[])
+
+    def to_batch(batch):
+        return HazardBatch(
+            np.array(batch['locations']),
+            np.array(batch['imts']),
+            np.array(batch['aggs']),
+            np.array(batch['levels'], dtype='float64'),
+            np.array(batch['apoe'], dtype='float64'),
+        )
+
+    batch = empty_batch()
+    for re in res:
+        label = re.rlz if kind == 'rlz' else re.agg
+        for r in re.values:
+            batch['locations'].append(re.loc)
+            batch['imts'].append(r.imt)
+            batch['aggs'].append(label)
+            batch['levels'].append(r.lvls)
+            batch['apoe'].append(r.vals)
+            if len(batch['imts']) == batch_size:
+                yield to_batch(batch)
+                batch = empty_batch()
+    if batch['imts']:
+        yield to_batch(batch)
+
+
 def retrieve_data(hazard_id, load_rlz=True):
     '''
     Retrieves the data and metadata from toshi-hazard-store and producing legacy data structure (designed by Anne H.).
@@ -33,52 +85,63 @@ def retrieve_data(hazard_id, load_rlz=True):
         sites.loc[s,'sids'] = i
     data['metadata']['sites'] = sites.to_dict()
     
-    data['metadata']['rlz_weights'] = rlzs_df['weight'].to_list()
+    data['metadata']['rlz_weights'] = rlzs_df['weight'].to_numpy()
 
     nsites = len(m.locs)
     nimts = len(m.imts)
+    nstats = 1 + len(data['metadata']['quantiles'])
+
+    # position along each axis of the legacy arrays
+    site_index = {}
+    for i, site in enumerate(data['metadata']['sites']['custom_site_id'].values()):
+        site_index.setdefault(site, i)
+    imt_index = {imt: i for i, imt in enumerate(data['metadata']['acc_imtls'].keys())}
+    quant_index = {'mean': 0}
+    quant_index.update({q: i + 1 for i, q in enumerate(data['metadata']['quantiles'])})
 
-    # TODO is there a better way to tget the number of levels?
-    re = next(query.get_hazard_stats_curves_v2(hazard_id))
-    nimtls = len(re.values[0].lvls)
-    
-    stats_array = np.empty((nsites,nimts,nimtls,1+len(data['metadata']['quantiles'])))
-    stats_array[:] = np.nan
-    
     data['hcurves'] = {}
-    res = query.get_hazard_stats_curves_v2(hazard_id) # TODO one arg
-    for re in res:
-        site = re.loc
-        for r in re.values:
-            imt = r.imt 
-            idx_imt = list(data['metadata']['acc_imtls'].keys()).index(imt)
-            idx_site = list(data['metadata']['sites']['custom_site_id'].values()).index(site)
-            
-            idx_quant = data['metadata']['quantiles'].index(float(re.agg))+1 if re.agg!='mean' else 0
+    stats_array = None
+    for batch in iter_hazard_batches(hazard_id, 'stats'):
+        if stats_array is None:
+            # the number of levels is only known once the first curves arrive
+            stats_array = np.full((nsites, nimts, batch.apoe.shape[1], nstats), np.nan)
+        idx_site = _positions(site_index, batch.locations)
+        idx_imt = _positions(imt_index, batch.imts)
+        idx_quant = _positions(quant_index, batch.aggs, lambda agg: agg if agg == 'mean' else float(agg))
+        stats_array[idx_site, idx_imt, :, idx_quant] = batch.apoe
 
-            data['metadata']['acc_imtls'][imt] = r.lvls
-            stats_array[idx_site, idx_imt,:,idx_quant] = r.vals
-    data['hcurves']['hcurves_stats'] = stats_array.tolist()
+        imts, first = np.unique(batch.imts, return_index=True)
+        for imt, i in zip(imts, first):
+            data['metadata']['acc_imtls'][imt] = batch.levels[i].tolist()
+    if stats_array is None:
+        stats_array = np.full((nsites, nimts, 0, nstats), np.nan)
+    data['hcurves']['hcurves_stats'] = stats_array
 
     
     if load_rlz:
         nrlzs = len(rlzs_df.index)
-        rlzs_array = np.empty((nsites,nimts,nimtls,nrlzs))
-        rlzs_array[:] = np.nan
-
-        res = query.get_hazard_rlz_curves_v2(hazard_id)
-        for re in res:
-            site = re.loc
-            idx_rlz = int(re.rlz)
-            for r in re.values:
-                imt = r.imt
-                idx_imt = list(data['metadata']['acc_imtls'].keys()).index(imt)
-                idx_site = list(data['metadata']['sites']['custom_site_id'].values()).index(site)
-                
-                rlzs_array[idx_site, idx_imt,:,idx_rlz] = r.vals
-        data['hcurves']['hcurves_rlzs'] = rlzs_array.tolist()
+        rlzs_array = None
+        for batch in iter_hazard_batches(hazard_id, 'rlz'):
+            if rlzs_array is None:
+                rlzs_array = np.full((nsites, nimts, batch.apoe.shape[1], nrlzs), np.nan)
+            idx_site = _positions(site_index, batch.locations)
+            idx_imt = _positions(imt_index, batch.imts)
+            idx_rlz = batch.aggs.astype(int)
+            rlzs_array[idx_site, idx_imt, :, idx_rlz] = batch.apoe
+        if rlzs_array is None:
+            rlzs_array = np.full((nsites, nimts, stats_array.shape[2], nrlzs), np.nan)
+        data['hcurves']['hcurves_rlzs'] = rlzs_array
     
     
     data['metadata']['disp_imtls'] = convert_imtls_to_disp(data['metadata']['acc_imtls'])
         
     return data
+
+
+def _positions(index, labels, key=lambda label: label):
+    '''
+    position of each label in an index dict, looking up each distinct label once
+    '''
+
+    uniques, inverse = np.unique(labels, return_inverse=True)
+    return np.array([index[key(label)] for label in uniques], dtype=int)[inverse]
@@ -1,10 +1,139 @@
+from functools import lru_cache
+
 from nzshm_hazlab.base_functions import *
 from nzshm_common.location import location
 
-def retrieve_data(file_id,named_sites=True):
+
+class LazyHDF5Array:
+    '''
+    h5py backed view of an OpenQuake hcurves dataset ([site, rlz, imt, imtl] on disk) with the axis order
+    [site, imt, imtl, rlz] used by the legacy data structure. Data are only read when indexed or converted
+    with np.asarray; the file is opened for each read so no handle is held.
+
+    The view can be restricted to a selection of sites, imts and realizations (positions along the disk
+    axes). Only the hyperslabs covering the requested elements are read from the file. As in h5py, lists
+    index each axis independently (outer indexing). A single ellipsis is expanded to full slices; new axes
+    (None) are not supported.
+    '''
+
+    DISK_AXES = ('site', 'rlz', 'imt', 'imtl')
+    VIEW_AXES = ('site', 'imt', 'imtl', 'rlz')
+
+    def __init__(self, filepath, dataset_name, sites=None, imts=None, rlzs=None):
+        import h5py
+
+        self._filepath = str(filepath)
+        self._dataset_name = dataset_name
+        with h5py.File(self._filepath, 'r') as hf:
+            disk_shape = hf[dataset_name].shape
+            self.dtype = hf[dataset_name].dtype
+
+        selectors = dict(site=sites, rlz=rlzs, imt=imts, imtl=None)
+        self._index = {
+            ax: np.arange(n) if selectors[ax] is None else np.arange(n)[np.asarray(selectors[ax], dtype=int)]
+            for ax, n in zip(self.DISK_AXES, disk_shape)
+        }
+        self.shape = tuple(len(self._index[ax]) for ax in self.VIEW_AXES)
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def select(self, sites=None, imts=None, rlzs=None):
+        '''
+        a view restricted further to positions along the site, imt and rlz axes of this view
+        '''
+
+        def compose(ax, selector):
+            return self._index[ax] if selector is None else self._index[ax][np.asarray(selector, dtype=int)]
+
+        view = object.__new__(LazyHDF5Array)
+        view.__dict__.update(self.__dict__)
+        view._index = dict(self._index, site=compose('site', sites), imt=compose('imt', imts), rlz=compose('rlz', rlzs))
+        view.shape = tuple(len(view._index[ax]) for ax in self.VIEW_AXES)
+        return view
+
+    def __getitem__(self, key):
+        import h5py
+
+        key = key if isinstance(key, tuple) else (key,)
+        if any(k is None for k in key):
+            raise IndexError('LazyHDF5Array does not support new axes (None)')
+        n_ellipsis = sum(k is Ellipsis for k in key)
+        if n_ellipsis > 1:
+            raise IndexError("an index can only have a single ellipsis ('...')")
+        if len(key) - n_ellipsis > self.ndim:
+            raise IndexError(f'too many indices for LazyHDF5Array: array is {self.ndim}-dimensional')
+        fill = (slice(None),) * (self.ndim - len(key) + n_ellipsis)
+        if n_ellipsis:
+            i = next(i for i, k in enumerate(key) if k is Ellipsis)
+            key = key[:i] + fill + key[i + 1:]
+        else:
+            key = key + fill
+        view_key = dict(zip(self.VIEW_AXES, key))
+
+        # requested positions along each disk axis; integer keys drop the axis
+        positions = {ax: self._index[ax][view_key[ax]] for ax in self.DISK_AXES}
+        kept = [ax for ax in self.DISK_AXES if np.ndim(positions[ax]) == 1]
+
+        # read the sorted unique positions, as slices where they are contiguous
+        unique, inverse, reads = {}, {}, {}
+        for ax in self.DISK_AXES:
+            unique[ax], inverse[ax] = np.unique(np.atleast_1d(positions[ax]), return_inverse=True)
+            u = unique[ax]
+            reads[ax] = slice(u[0], u[-1] + 1) if len(u) and u[-1] - u[0] + 1 == len(u) else u
+
+        # h5py allows a single list per selection: keep the longest as a list and loop over the others
+        list_axes = [ax for ax in self.DISK_AXES if not isinstance(reads[ax], slice)]
+        fancy = max(list_axes, key=lambda ax: len(reads[ax]), default=None)
+        loop_axes = [ax for ax in list_axes if ax != fancy]
+
+        shape = tuple(len(unique[ax]) for ax in self.DISK_AXES)
+        if not loop_axes and all(shape):
+            # a single hyperslab: read it straight into the result
+            with h5py.File(self._filepath, 'r') as hf:
+                values = hf[self._dataset_name][tuple(reads[ax] for ax in self.DISK_AXES)]
+        else:
+            values = np.empty(shape, dtype=self.dtype)
+        if values.size and loop_axes:
+            with h5py.File(self._filepath, 'r') as hf:
+                dset = hf[self._dataset_name]
+                for loop_idx in np.ndindex(*(len(reads[ax]) for ax in loop_axes)):
+                    disk_key = dict(reads)
+                    out_key = {ax: slice(None) for ax in self.DISK_AXES}
+                    for ax, i in zip(loop_axes, loop_idx):
+                        disk_key[ax] = slice(reads[ax][i], reads[ax][i] + 1)
+                        out_key[ax] = slice(i, i + 1)
+                    out = tuple(out_key[ax] for ax in self.DISK_AXES)
+                    values[out] = dset[tuple(disk_key[ax] for ax in self.DISK_AXES)]
+
+        # restore the requested order (and any repeats), then drop integer indexed axes. Selections that
+        # are already sorted and unique (e.g. full reads) are used as read to avoid a second copy.
+        if not all(np.array_equal(inverse[ax].ravel(), np.arange(len(unique[ax]))) for ax in self.DISK_AXES):
+            values = values[np.ix_(*(inverse[ax].ravel() for ax in self.DISK_AXES))]
+        values = values.reshape(tuple(len(inverse[ax].ravel()) for ax in kept))
+
+        order = [kept.index(ax) for ax in self.VIEW_AXES if ax in kept]
+        return np.transpose(values, order)
+
+    def __array__(self, dtype=None, copy=None):
+        values = self[:]
+        return values if dtype is None else values.astype(dtype)
+
+
+def retrieve_data(file_id,named_sites=True,lazy=False,sites=None,imts=None,rlzs=None):
     '''
     retrieves the relevant data and metadata from an oq .hdf5 file and stores it in a dictionary
+
+    hazard curves are numpy arrays, or LazyHDF5Array views if lazy is True (the file must then be kept).
+    Use base_functions.save_json to serialise the dictionary.
+
+    sites (positions or site names), imts (names or positions) and rlzs (positions) select a subset of the
+    calculation; only that part of the curves is read and the metadata are reduced to match. Selections
+    are kept in file order and rlz_weights are those of the selected realizations.
     '''
+    import h5py
+    from openquake.commonlib import datastore
 
     data = {}
 
@@ -14,22 +143,36 @@ def retrieve_data(file_id,named_sites=True):
     data['metadata']['quantiles'] = oqparam['quantiles']
     
     acc_imtls = oqparam['hazard_imtls']
+    imt_names = list(acc_imtls.keys())
+    if imts is not None:
+        imts = np.unique([imt_names.index(imt) if isinstance(imt, str) else int(imt) for imt in imts])
+        acc_imtls = {imt_names[i]: acc_imtls[imt_names[i]] for i in imts}
     data['metadata']['acc_imtls'] = acc_imtls
     data['metadata']['disp_imtls'] = convert_imtls_to_disp(acc_imtls) 
     
+    sitecol = dstore.read_df('sitecol')
     if named_sites:
-        data['metadata']['sites'] = find_site_names(dstore.read_df('sitecol')).to_dict()
-    else:
-        data['metadata']['sites'] = dstore.read_df('sitecol').to_dict()
+        sitecol = find_site_names(sitecol)
+    if sites is not None:
+        site_names = list(sitecol.index)
+        sites = np.unique([site_names.index(site) if isinstance(site, str) else int(site) for site in sites])
+        sitecol = sitecol.iloc[sites]
+    data['metadata']['sites'] = sitecol.to_dict()
 
     dstore.close()
 
+    data['hcurves'] = {}
     with h5py.File(file_id, 'r') as hf:
-        data['metadata']['rlz_weights'] = hf['weights'][:].tolist()
-        
-        data['hcurves'] = {}
-        data['hcurves']['hcurves_rlzs'] = np.moveaxis(hf['hcurves-rlzs'][:], 1, 3).tolist() #[site,imt,imtl,realizations (source*gmpe) ] (order after moveaxis)
-        data['hcurves']['hcurves_stats'] = np.moveaxis(hf['hcurves-stats'][:], 1, 3).tolist() #[site,imt,imtl,mean+quantiles] (order after moveaxis)
+        data['metadata']['rlz_weights'] = hf['weights'][:]
+    if rlzs is not None:
+        rlzs = np.unique(np.asarray(rlzs, dtype=int))
+        data['metadata']['rlz_weights'] = data['metadata']['rlz_weights'][rlzs]
+
+    #[site,imt,imtl,realizations (source*gmpe) ] and [site,imt,imtl,mean+quantiles]
+    hcurves_rlzs = LazyHDF5Array(file_id, 'hcurves-rlzs', sites=sites, imts=imts, rlzs=rlzs)
+    hcurves_stats = LazyHDF5Array(file_id, 'hcurves-stats', sites=sites, imts=imts)
+    data['hcurves']['hcurves_rlzs'] = hcurves_rlzs if lazy else np.asarray(hcurves_rlzs)
+    data['hcurves']['hcurves_stats'] = hcurves_stats if lazy else np.asarray(hcurves_stats)
 
     return data
 
@@ -46,39 +189,100 @@ def convert_imtls_to_disp(acc_imtls):
         
     return disp_imtls
 
-def find_site_names(sites,dtol=0.001):
+@lru_cache(maxsize=1)
+def _location_table():
     '''
-    sets site names as the index for the sites dataframe
+    names, ids, latitudes and longitudes of nzshm_common.location.LOCATIONS (built once)
+    '''
+
+    names = np.array([loc['name'] for loc in location.LOCATIONS], dtype=object)
+    ids = np.array([loc['id'] for loc in location.LOCATIONS], dtype=object)
+    lats = np.array([loc['latitude'] for loc in location.LOCATIONS], dtype=float)
+    lons = np.array([loc['longitude'] for loc in location.LOCATIONS], dtype=float)
+
+    id_names = {}
+    for name, loc_id in zip(names, ids):
+        id_names.setdefault(loc_id, []).append(name)
+
+    return names, lats, lons, id_names
+
+
+@lru_cache(maxsize=8)
+def _location_grid(dtol):
     '''
+    grid hash of the reference locations with cells of twice the tolerance, so any location within dtol
+    of a point falls in the 3x3 block of cells around it. Returns the cell size, the sorted cell keys
+    and the location indices in key order.
+    '''
+
+    _, lats, lons, _ = _location_table()
+    cell = 2 * dtol if dtol > 0 else 1.0
+    keys = _cell_keys(lats, lons, cell)
+    order = np.argsort(keys, kind='stable')
+    return cell, keys[order], order
 
-    def name_from_latlon(lat, lon, location_codes, dtol):
-        lat_idx = (location_codes['latitude'] >= lat-dtol) & (location_codes['latitude'] <= lat+dtol)
-        lon_idx = (location_codes['longitude'] >= lon-dtol) & (location_codes['longitude'] <= lon+dtol)
-        idx = lat_idx & lon_idx
-        if not True in idx.values:
-            return f'Lat: {lat:.2f}, Lon: {lon:.2f}'
-        return location_codes[lat_idx & lon_idx].index
 
-    location_codes = {}
-    for loc in location.LOCATIONS:
-        location_codes[loc['name']] = {'id':loc['id'],'latitude':loc['latitude'],'longitude':loc['longitude']}
-    location_codes = pd.DataFrame(location_codes).transpose()
+def _cell_keys(lats, lons, cell):
+    return np.floor(lats / cell).astype(np.int64) * 1_000_003 + np.floor(lons / cell).astype(np.int64)
 
 
-    sites.loc[0,'name'] = 'dummy'
+def nearest_location_names(lats, lons, dtol=0.001):
+    '''
+    names of the nearest reference location within dtol in both latitude and longitude of each point,
+    or 'Lat: .., Lon: ..' if there is none
+    '''
+
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    ref_names, ref_lats, ref_lons, _ = _location_table()
+    cell, keys, order = _location_grid(dtol)
+
+    # candidate (point, reference) pairs from the 3x3 block of cells around each point
+    points, refs = [], []
+    for dlat in (-1, 0, 1):
+        for dlon in (-1, 0, 1):
+            query_keys = _cell_keys(lats + dlat * cell, lons + dlon * cell, cell)
+            start = np.searchsorted(keys, query_keys, side='left')
+            counts = np.searchsorted(keys, query_keys, side='right') - start
+            point = np.repeat(np.arange(len(lats)), counts)
+            offset = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            points.append(point)
+            refs.append(order[np.repeat(start, counts) + offset])
+    points = np.concatenate(points)
+    refs = np.concatenate(refs)
+
+    within = (ref_lats[refs] >= lats[points] - dtol) & (ref_lats[refs] <= lats[points] + dtol) & \
+        (ref_lons[refs] >= lons[points] - dtol) & (ref_lons[refs] <= lons[points] + dtol)
+    points, refs = points[within], refs[within]
+    dist = (ref_lats[refs] - lats[points])**2 + (ref_lons[refs] - lons[points])**2
+    nearest = np.lexsort((refs, dist, points))
+    points, first = np.unique(points[nearest], return_index=True)
+
+    names = np.array([f'Lat: {lat:.2f}, Lon: {lon:.2f}' for lat, lon in zip(lats, lons)], dtype=object)
+    names[points] = ref_names[refs[nearest][first]]
+    return names
+
+
+def find_site_names(sites,dtol=0.001):
+    '''
+    sets site names as the index for the sites dataframe
+    '''
+
+    _, _, _, id_names = _location_table()
+
     if 'custom_site_id' in sites:
-        for i in sites.index:
-            id_idx = location_codes['id'] == sites.loc[i,'custom_site_id']
-            if True in id_idx.values:
-                try:
-                    sites.loc[i,'name'] = location_codes[id_idx].index
-                except: #handle duplicate custom_site_ids by looking up by lat lon
-                    sites.loc[i,'name'] = name_from_latlon(sites.loc[i,'lat'], sites.loc[i,'lon'], location_codes, dtol)
-            else: #if it's not on the list just use the custom_site_id
-                sites.loc[i,'name'] = sites.loc[i,'custom_site_id']
+        site_ids = sites['custom_site_id'].to_numpy()
+        # if it's not on the list just use the custom_site_id
+        names = np.array([id_names[site_id][0] if len(id_names.get(site_id, [])) == 1 else site_id
+                          for site_id in site_ids], dtype=object)
+        # handle duplicate custom_site_ids by looking up by lat lon
+        duplicate = np.array([len(id_names.get(site_id, [])) > 1 for site_id in site_ids], dtype=bool)
+        if duplicate.any():
+            names[duplicate] = nearest_location_names(
+                sites['lat'].to_numpy()[duplicate], sites['lon'].to_numpy()[duplicate], dtol)
     else:
-        for i in sites.index:
-            sites.loc[i,'name'] = name_from_latlon(sites.loc[i,'lat'], sites.loc[i,'lon'], location_codes, dtol)
-    
+        names = nearest_location_names(sites['lat'].to_numpy(), sites['lon'].to_numpy(), dtol)
+
+    sites['name'] = names
     return sites.set_index('name')
 
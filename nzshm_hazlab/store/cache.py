@@ -0,0 +1,243 @@
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+from collections import namedtuple
+from itertools import product
+from pathlib import Path
+from typing import Callable, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pandas import DataFrame
+
+DEFAULT_CACHE_DIR = Path(os.environ.get('NZSHM_HAZLAB_CACHE', Path.home() / '.cache' / 'nzshm_hazlab'))
+DEFAULT_MAX_BYTES = 2 * 1024**3
+
+CachedCurves = namedtuple('CachedCurves', 'locations levels apoe')
+
+
+def _safe_name(name: str) -> str:
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', name)
+
+
+class CurveCache:
+    """
+    local Parquet cache for hazard store results, partitioned by hazard_id
+
+    Each entry is a file named by the hash of its key. Hazard curves are stored as one table per
+    (source, vs30, imt, agg) holding every location retrieved so far, so only missing locations are fetched.
+    The source names the backend that filled the entry so curves from different stores are never mixed.
+    The total size is bounded by max_bytes; the least recently used files are evicted first (reads
+    refresh the file modification time).
+    """
+
+    def __init__(self, cache_dir: Union[str, Path] = DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_MAX_BYTES):
+        self._cache_dir = Path(cache_dir)
+        self._max_bytes = max_bytes
+        self._cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, hazard_id: str, key: Tuple) -> Path:
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return Path(self._cache_dir, _safe_name(hazard_id), f'{digest}.parquet')
+
+    def read_table(self, hazard_id: str, key: Tuple) -> Optional[pa.Table]:
+        path = self._path(hazard_id, key)
+        if not path.exists():
+            return None
+        os.utime(path)
+        return pq.read_table(path)
+
+    def write_table(self, hazard_id: str, key: Tuple, table: pa.Table) -> None:
+        path = self._path(hazard_id, key)
+        path.parent.mkdir(exist_ok=True)
+        # a unique temporary file so concurrent writers of the same key cannot interleave
+        with tempfile.NamedTemporaryFile(dir=path.parent, suffix='.tmp', delete=False) as tmp_file:
+            tmp_path = Path(tmp_file.name)
+        try:
+            pq.write_table(table, tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+        self.evict()
+
+    def read_frame(self, hazard_id: str, key: Tuple) -> Optional[DataFrame]:
+        table = self.read_table(hazard_id, key)
+        return None if table is None else table.to_pandas()
+
+    def write_frame(self, hazard_id: str, key: Tuple, frame: DataFrame) -> None:
+        self.write_table(hazard_id, key, pa.Table.from_pandas(frame, preserve_index=False))
+
+    def size(self) -> int:
+        return sum(path.stat().st_size for path in self._cache_dir.glob('*/*.parquet'))
+
+    def evict(self) -> None:
+        """remove least recently used entries until the cache fits in max_bytes"""
+
+        entries = [(path.stat(), path) for path in self._cache_dir.glob('*/*.parquet')]
+        total = sum(stat.st_size for stat, _ in entries)
+        for stat, path in sorted(entries, key=lambda entry: entry[0].st_mtime):
+            if total <= self._max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= stat.st_size
+
+    def invalidate(self, hazard_id: str) -> None:
+        """remove all entries for a hazard_id"""
+
+        shutil.rmtree(Path(self._cache_dir, _safe_name(hazard_id)), ignore_errors=True)
+
+    def clear(self) -> None:
+        for path in self._cache_dir.iterdir():
+            if path.is_dir():
+                shutil.rmtree(path)
+
+    def _read_curves(self, hazard_id: str, source: str, vs30: int, imt: str, agg: str) -> Optional[CachedCurves]:
+        table = self.read_table(hazard_id, ('curves', source, vs30, imt, agg))
+        if table is None:
+            return None
+        nrows = table.num_rows
+        levels = table.column('level').combine_chunks().flatten().to_numpy().reshape(nrows, -1)
+        apoe = table.column('apoe').combine_chunks().flatten().to_numpy().reshape(nrows, -1)
+        return CachedCurves(table.column('location').to_numpy(zero_copy_only=False), levels, apoe)
+
+    def _write_curves(self, hazard_id: str, source: str, vs30: int, imt: str, agg: str, curves: CachedCurves) -> None:
+        nlevels = curves.apoe.shape[1]
+        table = pa.table({
+            'location': pa.array(curves.locations, type=pa.string()),
+            'level': pa.FixedSizeListArray.from_arrays(pa.array(curves.levels.ravel()), nlevels),
+            'apoe': pa.FixedSizeListArray.from_arrays(pa.array(curves.apoe.ravel()), nlevels),
+        })
+        self.write_table(hazard_id, ('curves', source, vs30, imt, agg), table)
+
+    def get_curves(
+            self,
+            hazard_id: str,
+            vs30: int,
+            loc_strs: List[str],
+            imts: List[str],
+            aggs: List[str],
+            fetch: Callable[[List[str], List[str], List[str]], DataFrame],
+            source: str = 'ths',
+    ) -> DataFrame:
+        """
+        hazard curves in the store.curves.get_hazard schema, calling fetch(loc_strs, imts, aggs) only for
+        the locations, imts and aggs that are not cached. source identifies the backend behind fetch and
+        is part of the cache key. Locations requested but not returned by fetch are
+        cached as missing (NaN) so they are not requested again.
+        """
+
+        cached = {}
+        missing = {}
+        for imt, agg in product(imts, aggs):
+            curves = self._read_curves(hazard_id, source, vs30, imt, agg)
+            cached[(imt, agg)] = curves
+            have = set() if curves is None else set(curves.locations)
+            missing[(imt, agg)] = tuple(loc for loc in loc_strs if loc not in have)
+
+        for fetch_locs, fetch_imts, fetch_aggs in self._fetch_groups(missing):
+            fetched = fetch(list(fetch_locs), fetch_imts, fetch_aggs)
+            fetched_codes = (fetched['lat'].astype(str) + '~' + fetched['lon'].astype(str)).to_numpy()
+            nlevels = len(fetched['apoe'].iloc[0]) if len(fetched) else None
+            for imt, agg in product(fetch_imts, fetch_aggs):
+                rows = ((fetched['imt'] == imt) & (fetched['agg'] == agg)).to_numpy()
+                curves = self._merge(cached[(imt, agg)], fetch_locs, fetched_codes[rows], fetched.loc[rows], nlevels)
+                self._write_curves(hazard_id, source, vs30, imt, agg, curves)
+                cached[(imt, agg)] = curves
+
+        return self._assemble(cached, loc_strs)
+
+    @staticmethod
+    def _fetch_groups(missing):
+        """
+        (locations, imts, aggs) to fetch so that only missing curves are requested: (imt, agg) pairs
+        missing the same locations are grouped, and within those the aggs missing the same imts
+        """
+
+        by_locs = {}
+        for (imt, agg), locs in missing.items():
+            if locs:
+                by_locs.setdefault(locs, {}).setdefault(agg, []).append(imt)
+
+        groups = []
+        for locs, agg_imts in by_locs.items():
+            by_imts = {}
+            for agg, imts in agg_imts.items():
+                by_imts.setdefault(tuple(imts), []).append(agg)
+            groups += [(locs, list(imts), aggs) for imts, aggs in by_imts.items()]
+        return groups
+
+    @staticmethod
+    def _merge(
+            curves: Optional[CachedCurves],
+            requested: Sequence[str],
+            codes,
+            fetched: DataFrame,
+            nlevels: Optional[int],
+    ) -> CachedCurves:
+        """
+        the cached curves with the fetched rows for locations that were missing added, and NaN rows for
+        requested locations that fetch did not return. If nothing has been returned yet the number of
+        levels is unknown and the NaN rows are one level wide; they are widened when curves arrive.
+        """
+
+        if curves is not None:
+            new_rows = ~np.isin(codes, curves.locations)
+            codes, fetched = codes[new_rows], fetched.loc[new_rows]
+        if len(fetched):
+            levels = np.stack(fetched['level'].to_numpy()).astype('float64')
+            apoe = np.stack(fetched['apoe'].to_numpy()).astype('float64')
+        else:
+            nlevels = nlevels or (curves.apoe.shape[1] if curves is not None else 1)
+            levels = apoe = np.empty((0, nlevels))
+
+        have = set(codes) if curves is None else set(codes) | set(curves.locations)
+        absent = [loc for loc in requested if loc not in have]
+        if absent:
+            nan_block = np.full((len(absent), apoe.shape[1]), np.nan)
+            codes = np.concatenate((codes, absent))
+            levels = np.vstack((levels, nan_block))
+            apoe = np.vstack((apoe, nan_block))
+
+        if curves is not None:
+            old_levels, old_apoe = curves.levels, curves.apoe
+            if old_apoe.shape[1] != apoe.shape[1]:
+                # only placeholder (all NaN) blocks can differ in width from the fetched curves
+                if np.isnan(old_apoe).all():
+                    old_levels = old_apoe = np.full((len(curves.locations), apoe.shape[1]), np.nan)
+                elif np.isnan(apoe).all():
+                    levels = apoe = np.full((len(codes), old_apoe.shape[1]), np.nan)
+                else:
+                    raise ValueError(f'cannot merge curves with {old_apoe.shape[1]} and {apoe.shape[1]} levels')
+            codes = np.concatenate((curves.locations, codes))
+            levels = np.vstack((old_levels, levels))
+            apoe = np.vstack((old_apoe, apoe))
+
+        return CachedCurves(np.asarray(codes, dtype=object), levels, apoe)
+
+    @staticmethod
+    def _assemble(cached, loc_strs: List[str]) -> DataFrame:
+        frames = []
+        for (imt, agg), curves in cached.items():
+            if curves is None:
+                continue
+            index = {loc: i for i, loc in enumerate(curves.locations)}
+            rows = np.array([index[loc] for loc in loc_strs if loc in index], dtype=int)
+            rows = rows[~np.isnan(curves.apoe[rows]).any(axis=1)]
+            codes = pd.Series(curves.locations[rows], dtype=object)
+            lat_lon = codes.str.split('~', expand=True)
+            frames.append(pd.DataFrame({
+                'lat': lat_lon[0] if len(rows) else codes,
+                'lon': lat_lon[1] if len(rows) else codes,
+                'imt': imt,
+                'agg': agg,
+                'level': list(curves.levels[rows]),
+                'apoe': list(curves.apoe[rows]),
+            }))
+        if not frames:
+            return pd.DataFrame(columns=['lat', 'lon', 'imt', 'agg', 'level', 'apoe'])
+        return pd.concat(frames, ignore_index=True)
@@ -4,9 +4,10 @@ from pandas import DataFrame
 from pathlib import Path
 import math
 import csv
-from typing import List, Any
+from typing import List, Any, Callable, Iterable, Iterator, Optional, Sequence
 import os
-from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque, namedtuple
 from itertools import product
 # import toshi_hazard_store
 import numpy as np
@@ -17,18 +18,112 @@ from nzshm_common.location.location import LOCATION_LISTS, location_by_id, LOCAT
 from nzshm_common.grids import RegionGrid
 from nzshm_common.location import CodedLocation
 
+from nzshm_hazlab.store.cache import CurveCache
+
 DTYPE = {'lat':'str', 'lon':'str', 'imt':'str', 'agg':'str', 'level':'str', 'apoe':'str'}
 SITE_LIST = 'NZ_0_1_NB_1_1'
 COLUMNS = ['lat', 'lon', 'imt', 'agg', 'level', 'apoe']
 RESOLUTION = 0.001
 
 RecordIdentifier = namedtuple('RecordIdentifier', 'location imt agg')
+HazardBatch = namedtuple('HazardBatch', 'locations imts aggs levels apoe')
 
 def chunks(lst, n):
     """Yield successive n-sized chunks from lst."""
     for i in range(0, len(lst), n):
         yield lst[i:i + n]
 
+def fetch_chunk(query_fn: Callable, args: Sequence, retries: int=3, backoff: float=1.0) -> List[Any]:
+    """run query_fn(*args) to completion, retrying with exponential backoff on failure"""
+
+    for attempt in range(retries + 1):
+        try:
+            return list(query_fn(*args))
+        except Exception as err:
+            if attempt == retries:
+                raise
+            wait = backoff * 2**attempt
+            print(f'query failed ({err!r}), retrying in {wait:.1f} seconds')
+            time.sleep(wait)
+
+
+def iter_chunked(
+        query_fn: Callable,
+        chunk_args: Iterable[Sequence],
+        max_workers: int=4,
+        retries: int=3,
+        backoff: float=1.0,
+) -> Iterator[List[Any]]:
+    """
+    run query_fn once per set of arguments on a bounded thread pool, yielding the result of each chunk in
+    the order of chunk_args as soon as it (and every earlier chunk) is complete. At most 2 * max_workers
+    chunks are queued or held at a time, so results are streamed rather than accumulated.
+    """
+
+    if max_workers <= 1:
+        for args in chunk_args:
+            yield fetch_chunk(query_fn, args, retries, backoff)
+        return
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        try:
+            for args in chunk_args:
+                pending.append(executor.submit(fetch_chunk, query_fn, args, retries, backoff))
+                if len(pending) >= 2 * max_workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def fetch_chunked(
+        query_fn: Callable,
+        chunk_args: Iterable[Sequence],
+        max_workers: int=4,
+        retries: int=3,
+        backoff: float=1.0,
+) -> List[List[Any]]:
+    """
+    run query_fn once per set of arguments on a bounded thread pool. The results for each chunk are
+    returned in the order of chunk_args regardless of completion order.
+    """
+
+    return list(iter_chunked(query_fn, chunk_args, max_workers, retries, backoff))
+
+
+def fetch_hazard_curves(
+        hazard_id: str,
+        vs30: int,
+        loc_strs: List[str],
+        imts: List[str],
+        aggs: List[str],
+        loc_chunk_size: int=100,
+        imt_chunk_size: int=0,
+        max_workers: int=4,
+        retries: int=3,
+        backoff: float=1.0,
+        query_module: Any=query,
+) -> Iterable[Any]:
+    """
+    retrieve hazard curve records from THS in location x imt chunks run concurrently. Records are
+    yielded in chunk order (locations outer, imts inner) as each chunk completes. An imt_chunk_size of 0 puts all imts in
+    one chunk. query_module can be replaced by any object with a get_hazard_curves function, e.g. a
+    local stub for timing.
+    """
+
+    imt_chunk_size = imt_chunk_size or len(imts)
+    chunk_args = [
+        (loc_chunk, [vs30], [hazard_id], imt_chunk, aggs)
+        for loc_chunk in chunks(loc_strs, loc_chunk_size)
+        for imt_chunk in chunks(imts, imt_chunk_size)
+    ]
+    for chunk_result in iter_chunked(query_module.get_hazard_curves, chunk_args, max_workers, retries, backoff):
+        yield from chunk_result
+
+
 def lat_lon(id):
     return location_by_id(id)['latitude'], location_by_id(id)['longitude']
 
@@ -55,6 +150,80 @@ def clean_df(hazard_curves: DataFrame) -> DataFrame:
     return hazard_curves.dropna()
 
 
+class CurveColumns:
+    """
+    columnar accumulator for hazard curve records. Record attributes are collected into flat lists and
+    the levels and apoes into a single (n_records, n_levels) float64 block when the DataFrame is built,
+    avoiding per-cell DataFrame writes.
+    """
+
+    def __init__(self):
+        self._lat: List[float] = []
+        self._lon: List[float] = []
+        self._imt: List[str] = []
+        self._agg: List[str] = []
+        self._level: List[List[float]] = []
+        self._apoe: List[List[float]] = []
+
+    def __len__(self):
+        return len(self._imt)
+
+    def append(self, res) -> None:
+        self._lat.append(res.lat)
+        self._lon.append(res.lon)
+        self._imt.append(res.imt)
+        self._agg.append(res.agg)
+        self._level.append([item.lvl for item in res.values])
+        self._apoe.append([item.val for item in res.values])
+
+    def _lat_lon_strs(self):
+        lat = np.char.mod('%0.3f', np.array(self._lat, dtype='float64'))
+        lon = np.char.mod('%0.3f', np.array(self._lon, dtype='float64'))
+        return lat.astype(object), lon.astype(object)
+
+    def blocks(self):
+        """levels and apoes as (n_records, n_levels) float64 arrays"""
+        if not len(self):
+            return np.empty((0, 0)), np.empty((0, 0))
+        levels = np.array(self._level, dtype='float64').reshape(len(self), -1)
+        apoes = np.array(self._apoe, dtype='float64').reshape(len(self), -1)
+        return levels, apoes
+
+    def to_batch(self) -> HazardBatch:
+        """location codes, imts and aggs as arrays and levels/apoe as (n_records, n_levels) blocks"""
+        lat, lon = self._lat_lon_strs()
+        levels, apoes = self.blocks()
+        locations = np.char.add(np.char.add(lat.astype(str), '~'), lon.astype(str))
+        return HazardBatch(locations, np.array(self._imt, dtype=str), np.array(self._agg, dtype=str), levels, apoes)
+
+    def to_df(self) -> DataFrame:
+        """one row per record, level and apoe columns hold rows of the 2-D blocks"""
+        lat, lon = self._lat_lon_strs()
+        levels, apoes = self.blocks()
+        return pd.DataFrame({
+            'lat': lat,
+            'lon': lon,
+            'imt': np.array(self._imt, dtype=object),
+            'agg': np.array(self._agg, dtype=object),
+            'level': list(levels),
+            'apoe': list(apoes),
+        })
+
+    def to_long_df(self) -> DataFrame:
+        """one row per record and level"""
+        lat, lon = self._lat_lon_strs()
+        levels, apoes = self.blocks()
+        nlevels = levels.shape[1]
+        return pd.DataFrame({
+            'lat': np.repeat(lat, nlevels),
+            'lon': np.repeat(lon, nlevels),
+            'imt': np.repeat(np.array(self._imt, dtype=object), nlevels),
+            'agg': np.repeat(np.array(self._agg, dtype=object), nlevels),
+            'level': levels.ravel(),
+            'apoe': apoes.ravel(),
+        })
+
+
 def get_hazard_v1(
         hazard_id: str,
         vs30: int,
@@ -66,26 +235,10 @@ def get_hazard_v1(
     """download all locations, imts and aggs for a particular hazard_id and vs30."""
 
     loc_strs = [loc.downsample(RESOLUTION).code for loc in locs]
-    naggs = len(aggs)
-    nimts = len(imts)
-    hazards = query.get_hazard_curves(
-        hazard_model_ids=[hazard_id],
-        vs30s = [vs30],
-        locs = loc_strs[:1],
-        imts = imts,
-        aggs = aggs,
-    )
-    res = next(hazards)
-    nlevels = len(res.values)
-
-    index = range(len(locs) * nimts * naggs * nlevels)
-    dtype = {'lat':'str', 'lon':'str', 'imt':'str', 'agg':'str', 'level':'float64', 'apoe':'float64'}
-    hazard_curves = pd.DataFrame({c: pd.Series(dtype=t) for c, t in dtype.items()}, index=index)
-    ind = 0
+    columns = CurveColumns()
     total_records = len(locs) * len(imts) * len(aggs)
     print(f'retrieving {total_records} records from THS')
     print_step = math.ceil(total_records / 10) 
-    # for i,res in enumerate(toshi_hazard_store.query_v3.get_hazard_curves(loc_strs, [vs30], [hazard_id], imts, aggs)):
     i = 0
     tic = time.perf_counter()
     for loc_chunks in chunks(loc_strs, chunk_size):
@@ -94,23 +247,40 @@ def get_hazard_v1(
                 toc = time.perf_counter()
                 print(f'retrieved {i / total_records * 100:.0f}% of records from THS in {toc-tic:.1f} seconds') 
                 tic = time.perf_counter()
-            lat = f'{res.lat:0.3f}'
-            lon = f'{res.lon:0.3f}'
-            for value in res.values:
-                hazard_curves.loc[ind,'lat'] = lat
-                hazard_curves.loc[ind,'lon'] = lon
-                hazard_curves.loc[ind,'imt'] = res.imt
-                hazard_curves.loc[ind,'agg'] = res.agg
-                hazard_curves.loc[ind,'level'] = float(value.lvl)
-                hazard_curves.loc[ind,'apoe'] = float(value.val)
-                ind += 1
+            columns.append(res)
             i += 1
 
-
-    hazard_curves = clean_df(hazard_curves)
+    hazard_curves = clean_df(columns.to_long_df())
 
     return hazard_curves
 
+def iter_hazard_batches(
+        hazard_id: str,
+        vs30: int,
+        locs: List[CodedLocation],
+        imts: List[str],
+        aggs: List[str],
+        batch_size: int=1000,
+        chunk_size: int=100,
+) -> Iterator[HazardBatch]:
+    """
+    stream hazard curves for a particular hazard_id and vs30 as HazardBatch blocks of at most batch_size
+    records. Locations are queried chunk_size at a time so that only one chunk of records and one batch
+    are held in memory.
+    """
+
+    loc_strs = [loc.downsample(RESOLUTION).code for loc in locs]
+    columns = CurveColumns()
+    for loc_chunk in chunks(loc_strs, chunk_size):
+        for res in query.get_hazard_curves(loc_chunk, [vs30], [hazard_id], imts, aggs):
+            columns.append(res)
+            if len(columns) == batch_size:
+                yield columns.to_batch()
+                columns = CurveColumns()
+    if len(columns):
+        yield columns.to_batch()
+
+
 def get_hazard_from_oqcsv(oqdir: str, imts: List[str], agg: str, run_num: int):
     """assumes loading individual realizations (could be used for aggregates, but the 'agg' column will be inccorect)"""
     
@@ -160,36 +330,37 @@ def get_hazard(
         imts: List[str],
         aggs: List[str],
         chunk_size: int=100,
+        imt_chunk_size: int=0,
+        max_workers: int=4,
+        cache: Optional[CurveCache]=None,
 ) -> DataFrame:
-    """download all locations, imts and aggs for a particular hazard_id and vs30."""
+    """
+    download all locations, imts and aggs for a particular hazard_id and vs30. If a cache is
+    provided only curves missing from it are downloaded.
+    """
 
     loc_strs = [loc.downsample(RESOLUTION).code for loc in locs]
-    naggs = len(aggs)
-    nimts = len(imts)
 
-    index = range(len(locs) * nimts * naggs)
-    hazard_curves = pd.DataFrame({c: pd.Series(dtype=t) for c, t in DTYPE.items()}, index=index)
-    total_records = len(locs) * len(imts) * len(aggs)
-    print(f'retrieving {total_records} records from THS')
-    print_step = math.ceil(total_records / 10) 
-    # for i,res in enumerate(toshi_hazard_store.query_v3.get_hazard_curves(loc_strs, [vs30], [hazard_id], imts, aggs)):
-    tic = time.perf_counter()
-    # for loc_chunks in chunks(loc_strs, chunk_size):
-    for i, res in enumerate(query.get_hazard_curves(loc_strs, [vs30], [hazard_id], imts, aggs)):
-        if i%print_step == 0:
-            toc = time.perf_counter()
-            print(f'retrieved {i / total_records * 100:.0f}% of records from THS in {toc-tic:.1f} seconds') 
-            tic = time.perf_counter()
-        lat = f'{res.lat:0.3f}'
-        lon = f'{res.lon:0.3f}'
-        hazard_curves.loc[i,'lat'] = lat
-        hazard_curves.loc[i,'lon'] = lon
-        hazard_curves.loc[i,'imt'] = res.imt
-        hazard_curves.loc[i,'agg'] = res.agg
-        hazard_curves.loc[i,'level'] = np.array([float(item.lvl) for item in res.values])
-        hazard_curves.loc[i,'apoe'] = np.array([float(item.val) for item in res.values])
+    def fetch(loc_strs, imts, aggs):
+        columns = CurveColumns()
+        total_records = len(loc_strs) * len(imts) * len(aggs)
+        print(f'retrieving {total_records} records from THS with {max_workers} workers')
+        tic = time.perf_counter()
+        records = fetch_hazard_curves(
+            hazard_id, vs30, loc_strs, imts, aggs,
+            loc_chunk_size=chunk_size,
+            imt_chunk_size=imt_chunk_size,
+            max_workers=max_workers,
+        )
+        for res in records:
+            columns.append(res)
+        toc = time.perf_counter()
+        print(f'retrieved {len(columns)} records from THS in {toc-tic:.1f} seconds')
+        return columns.to_df()
 
-    return hazard_curves
+    if cache is not None:
+        return cache.get_curves(hazard_id, vs30, loc_strs, imts, aggs, fetch, source='ths')
+    return fetch(loc_strs, imts, aggs)
 
 if __name__ == "__main__":
 
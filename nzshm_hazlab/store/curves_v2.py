@@ -4,7 +4,7 @@ import pandas as pd
 from pandas import DataFrame
 from typing import List, Any
 from collections import namedtuple
-from toshi_hazard_store import query
+from nzshm_hazlab.store.curves import fetch_hazard_curves
 
 from nzshm_common.location.location import LOCATION_LISTS, location_by_id, LOCATIONS_BY_ID
 from nzshm_common.grids import RegionGrid
@@ -45,43 +45,54 @@ def clean_df(hazard_curves: DataFrame) -> DataFrame:
 
     return hazard_curves.dropna()
 
-def chunks(lst, n):
-    """Yield successive n-sized chunks from lst."""
-    for i in range(0, len(lst), n):
-        yield lst[i:i + n]
+class StubQuery:
+    """
+    local stand-in for toshi_hazard_store.query. Each call to get_hazard_curves costs a fixed latency
+    plus a per-record time, roughly mimicking a round trip to the store.
+    """
 
-def get_hazard(
-        hazard_id: str,
-        vs30: int,
-        locs: List[CodedLocation],
+    HazardCurve = namedtuple('HazardCurve', 'lat lon imt agg values')
+    Value = namedtuple('Value', 'lvl val')
+
+    def __init__(self, latency: float=0.2, per_record: float=0.0005, nlevels: int=44):
+        self._latency = latency
+        self._per_record = per_record
+        self._levels = [10**(-4 + 5*i/(nlevels-1)) for i in range(nlevels)]
+
+    def get_hazard_curves(self, locs, vs30s, hazard_model_ids, imts, aggs):
+        time.sleep(self._latency + self._per_record * len(locs) * len(imts) * len(aggs))
+        for loc in locs:
+            lat, lon = map(float, loc.split('~'))
+            for imt in imts:
+                for agg in aggs:
+                    values = [self.Value(lvl, 1.0 / (1.0 + 100*lvl)) for lvl in self._levels]
+                    yield self.HazardCurve(lat, lon, imt, agg, values)
+
+
+def time_fetch(
+        loc_strs: List[str],
         imts: List[str],
-        aggs: List[str]
+        aggs: List[str],
+        chunk_sizes: List[int],
+        worker_counts: List[int],
+        query_module: Any=None,
 ) -> DataFrame:
-    """download all locations, imts and aggs for a particular hazard_id and vs30."""
-
-    loc_strs = [loc.downsample(RESOLUTION).code for loc in locs]
-    naggs = len(aggs)
-    nimts = len(imts)
-
-    index = range(len(locs) * nimts * naggs)
-    hazard_curves = pd.DataFrame({c: pd.Series(dtype=t) for c, t in DTYPE.items()}, index=index)
-    total_records = len(locs) * len(imts) * len(aggs)
-    print(f'retrieving {total_records} records from THS')
-    csize = 5
-    print(f'timing retrival in location chunks of {csize}')
-    t0 = time.perf_counter()
-    cnt = 0
-    for loc_chunks in chunks(loc_strs[:25], csize):
-        print("get_hazard_curves", loc_chunks, [vs30], [hazard_id], imts, aggs)
-        for res in query.get_hazard_curves(loc_chunks, [vs30], [hazard_id], imts, aggs):
-            cnt = cnt+1
-            log.debug(res)
-            print(res)
-
-    t1 = time.perf_counter()
-    print(f'retrieved {cnt} records in {t1 - t0} seconds')
-
-    return hazard_curves
+    """time fetch_hazard_curves over a grid of location chunk sizes and worker counts"""
+
+    query_module = query_module or StubQuery()
+    timings = []
+    for chunk_size in chunk_sizes:
+        for max_workers in worker_counts:
+            t0 = time.perf_counter()
+            cnt = sum(1 for _ in fetch_hazard_curves(
+                'HAZARD_ID', 400, loc_strs, imts, aggs,
+                loc_chunk_size=chunk_size, max_workers=max_workers, query_module=query_module,
+            ))
+            t1 = time.perf_counter()
+            print(f'chunk size {chunk_size}, {max_workers} workers: retrieved {cnt} records in {t1 - t0:.2f} seconds')
+            timings.append(dict(chunk_size=chunk_size, max_workers=max_workers, records=cnt, seconds=t1 - t0))
+
+    return pd.DataFrame(timings)
 
 def grid_locations(site_list):
 
@@ -96,14 +107,6 @@ SITE_LIST = 'NZ_0_1_NB_1_1'
 
 if __name__ == "__main__":
 
-    # hazard_ids = [
-    #     "NSHM_v1.0.4",
-    # ]
-    hazard_id = "NSHM_v1.0.4"
-    vs30s = [275, 150, 400, 750, 175, 225, 375, 525]
-
-    from nzshm_hazlab.store.levels import grid_locations, SITE_LIST
-
     imts = [
         'PGA', 'SA(0.1)', 'SA(0.15)', 'SA(0.2)', 'SA(0.25)',
         'SA(0.3)', 'SA(0.35)', 'SA(0.4)', 'SA(0.5)', 'SA(0.6)',
@@ -113,9 +116,7 @@ if __name__ == "__main__":
         'SA(7.5)', 'SA(10.0)'
     ]
     aggs = ["mean"]
-    locations = list(grid_locations(SITE_LIST)) +\
-        [CodedLocation( *lat_lon(id), RESOLUTION) for id in LOCATIONS_BY_ID.keys()]
-    
-    for vs30 in vs30s[:1]:
-        hazard = get_hazard(hazard_id, vs30, locations, imts, aggs)
-        print(hazard)
+    loc_strs = [loc.code for loc in grid_locations(SITE_LIST)][:500]
+
+    timings = time_fetch(loc_strs, imts, aggs, chunk_sizes=[10, 50, 100, 250], worker_counts=[1, 2, 4, 8])
+    print(timings.pivot(index='chunk_size', columns='max_workers', values='seconds'))
@@ -1,5 +1,6 @@
 import math
 
+from functools import lru_cache
 from itertools import product
 from typing import List, Tuple, Optional, Dict, Any
 from nzshm_common.location import CodedLocation
@@ -7,13 +8,14 @@ from enum import Enum, auto
 
 import pandas as pd
 import numpy as np
-import boto3
 import pyarrow as pa
 import pyarrow.dataset as ds
 import pyarrow.compute as pc
 
 from pyarrow import fs
 
+from nzshm_hazlab.store.cache import CurveCache
+
 imtls = np.array([
     0.0001, 0.0002, 0.0004, 0.0006, 0.0008,
     0.001, 0.002, 0.004, 0.006, 0.008,
@@ -28,50 +30,142 @@ class ArrowFS(Enum):
     LOCAL = auto()
     AWS = auto()
 
+# default scan settings, see configure_arrow_io and get_hazard
+SCAN_SPECS = dict(
+    batch_readahead=16,
+    fragment_readahead=4,
+    pre_buffer=True,
+)
+
+
+def configure_arrow_io(io_threads: Optional[int] = None, cpu_threads: Optional[int] = None) -> None:
+    """set the size of Arrow's global IO (e.g. concurrent S3 requests) and CPU thread pools"""
+
+    if io_threads:
+        pa.set_io_thread_count(io_threads)
+    if cpu_threads:
+        pa.set_cpu_count(cpu_threads)
+
+
 def get_local_fs(local_dir) -> Tuple[fs.FileSystem, str]:
     return fs.LocalFileSystem(), str(local_dir)
 
 
-def get_s3_fs(region, bucket) -> Tuple[fs.FileSystem, str]:
-    session = boto3.session.Session()
-    credentials = session.get_credentials()
-    filesystem = fs.S3FileSystem(
-        secret_key=credentials.secret_key,
-        access_key=credentials.access_key,
-        region=region,
-        session_token=credentials.token,
-    )
+def get_s3_fs(region, bucket, endpoint_override: Optional[str] = None) -> Tuple[fs.FileSystem, str]:
+    """
+    S3 filesystem using the default AWS credential chain (environment, shared config and credentials
+    files, SSO, instance profile). The credentials are resolved and refreshed by the filesystem itself,
+    so temporary (STS/SSO) credentials are renewed in long running processes. endpoint_override points at
+    an S3 compatible service (e.g. a local MinIO server, 'http://localhost:9000')
+    """
+
+    filesystem = fs.S3FileSystem(region=region, endpoint_override=endpoint_override)
     root = bucket
     return filesystem, root
 
 
+@lru_cache(maxsize=None)
 def get_arrow_filesystem(
         fs_type: ArrowFS,
         aws_region: Optional[str] = None,
         local_dir: Optional[str] = None,
         s3_bucket: Optional[str] = None,
+        s3_endpoint: Optional[str] = None,
 ) -> Tuple[fs.FileSystem, str]:
+    """
+    filesystem and dataset root, created once per set of arguments and reused. Use clear_dataset_cache
+    (or get_arrow_filesystem.cache_clear()) to create new filesystems, e.g. after changing AWS profile.
+    """
 
     if fs_type is ArrowFS.LOCAL:
         filesystem, root = get_local_fs(local_dir)
     elif fs_type is ArrowFS.AWS:
-        filesystem, root = get_s3_fs(aws_region, s3_bucket)
+        filesystem, root = get_s3_fs(aws_region, s3_bucket, s3_endpoint)
     else:
-        filesystem = root = None
+        raise ValueError(f'unknown filesystem type {fs_type}')
     return filesystem, root
 
 
-def get_aggs_dataset(fs_specs):
+@lru_cache(maxsize=None)
+def _discover_dataset(
+        fs_type: ArrowFS,
+        aws_region: Optional[str],
+        local_dir: Optional[str],
+        s3_bucket: Optional[str],
+        s3_endpoint: Optional[str],
+) -> ds.FileSystemDataset:
+    filesystem, root = get_arrow_filesystem(fs_type, aws_region, local_dir, s3_bucket, s3_endpoint)
+    return ds.dataset(root, format='parquet', filesystem=filesystem, partitioning='hive')
+
+
+def get_aggs_dataset(fs_specs: Dict[str, Any]) -> ds.FileSystemDataset:
+    """
+    the aggregate curves dataset described by fs_specs. Fragment discovery is done once per dataset
+    root and the dataset is reused by later calls; use clear_dataset_cache if the dataset changes.
+
+    fs_specs keys: 'arrow_fs' (ArrowFS), 'arrow_dir' for ArrowFS.LOCAL, and 'aws_region', 's3_bucket'
+    and optionally 's3_endpoint' for ArrowFS.AWS.
+    """
+
+    if fs_specs['arrow_fs'] is ArrowFS.LOCAL:
+        return _discover_dataset(ArrowFS.LOCAL, None, str(fs_specs['arrow_dir']), None, None)
+    elif fs_specs['arrow_fs'] is ArrowFS.AWS:
+        return _discover_dataset(
+            ArrowFS.AWS, fs_specs['aws_region'], None, fs_specs['s3_bucket'], fs_specs.get('s3_endpoint')
+        )
+    raise ValueError(f"unknown filesystem type {fs_specs['arrow_fs']}")
+
+
+def dataset_source(fs_specs: Dict[str, Any]) -> str:
+    """name of the dataset described by fs_specs, used to key cached curves"""
 
-    if fs_specs['arrow_fs'] == ArrowFS.LOCAL:
-        filesystem, root = get_arrow_filesystem(ArrowFS.LOCAL, local_dir=fs_specs['arrow_dir'])
-    elif fs_specs['arrow_fs'] == ArrowFS.AWS:
-        filesystem, root = get_arrow_filesystem(ArrowFS.LOCAL, aws_region=fs_specs['aws_region'], s3_bucket=fs_specs['s3_bucket'])
-    
-    dataset = ds.dataset(root, format='parquet', filesystem=filesystem, partitioning='hive')
-    return dataset
+    if fs_specs['arrow_fs'] is ArrowFS.LOCAL:
+        return f"curves_v4:{fs_specs['arrow_dir']}"
+    return f"curves_v4:s3://{fs_specs['s3_bucket']}"
+
+
+def clear_dataset_cache() -> None:
+    """forget the discovered datasets and the filesystems they were read with"""
+
+    _discover_dataset.cache_clear()
+    get_arrow_filesystem.cache_clear()
+
+
+def prune_partitions(dataset: ds.FileSystemDataset, partition_flt: pc.Expression) -> ds.FileSystemDataset:
+    """
+    restrict a hive partitioned dataset to the fragments whose partition keys can satisfy partition_flt
+    so that the remaining fragments are never opened
+    """
+
+    fragments = list(dataset.get_fragments(filter=partition_flt))
+    return ds.FileSystemDataset(fragments, dataset.schema, dataset.format, filesystem=dataset.filesystem)
+
+
+def values_block(values: pa.Array) -> np.ndarray:
+    """view a list (or fixed size list) array of equal length lists as a 2-D array without copying"""
+
+    width = values.type.list_size if pa.types.is_fixed_size_list(values.type) else len(imtls)
+    if len(values) == 0:
+        return np.empty((0, width))
+    flat = values.flatten()
+    return flat.to_numpy(zero_copy_only=False).reshape(len(values), -1)
+
+
+def curves_from_table(table: pa.Table, vs30: int) -> pd.DataFrame:
+    """convert a table of aggregate curves to the store.curves.get_hazard schema"""
+
+    lat_lon = pc.split_pattern(table.column('nloc_001'), pattern='~')
+    apoe_rows = [row for chunk in table.column('values').chunks for row in values_block(chunk)]
+    return pd.DataFrame({
+        'lat': pc.list_element(lat_lon, 0).to_numpy(),
+        'lon': pc.list_element(lat_lon, 1).to_numpy(),
+        'imt': table.column('imt').to_numpy(),
+        'agg': table.column('agg').to_numpy(),
+        'level': [imtls] * table.num_rows,
+        'apoe': apoe_rows,
+        'vs30': vs30,
+    })
 
-    
 
 def get_hazard(
         hazard_id: str,
@@ -80,32 +174,45 @@ def get_hazard(
         imts: List[str],
         aggs: List[str],
         fs_specs: Dict[str, Any],
+        cache: Optional[CurveCache] = None,
+        scan_specs: Optional[Dict[str, Any]] = None,
 ) -> pd.DataFrame:
-    """download all locations, imts and aggs for a particular hazard_id and vs30."""
-
-    dataset = get_aggs_dataset(fs_specs)
-
-    loc_strs = [loc.downsample(RESOLUTION).code for loc in locs]
-    naggs = len(aggs)
-    nimts = len(imts)
+    """
+    download all locations, imts and aggs for a particular hazard_id and vs30. If a cache is
+    provided only curves missing from it are read from the dataset. scan_specs overrides the
+    readahead and pre-buffer settings in SCAN_SPECS.
+    """
+
+    scan_specs = {**SCAN_SPECS, **(scan_specs or {})}
+
+    def fetch(nloc_001s, imts, aggs):
+        dataset = get_aggs_dataset(fs_specs)
+
+        partition_flt = (
+            (pc.field('vs30') == pc.scalar(vs30))
+            & (pc.field('hazard_model_id') == pc.scalar(hazard_id))
+            & (pc.is_in(pc.field('imt'), pa.array(imts)))
+        )
+        flt = (
+            partition_flt
+            & (pc.is_in(pc.field('agg'), pa.array(aggs)))
+            & (pc.is_in(pc.field('nloc_001'), pa.array(nloc_001s)))
+        )
+        columns = ['agg', 'imt', 'nloc_001', 'values']
+        arrow_scanner = ds.Scanner.from_dataset(
+            prune_partitions(dataset, partition_flt),
+            filter=flt,
+            columns=columns,
+            batch_readahead=scan_specs['batch_readahead'],
+            fragment_readahead=scan_specs['fragment_readahead'],
+            fragment_scan_options=ds.ParquetFragmentScanOptions(pre_buffer=scan_specs['pre_buffer']),
+        )
+        table = arrow_scanner.to_table()
+        return curves_from_table(table, vs30)
 
-    location = locs[0]
-    imt = imts[0]
     nloc_001s = [loc.downsample(0.001).code for loc in locs]
-    flt = (
-        (pc.is_in(pc.field('agg'), pa.array(aggs)))
-        & (pc.is_in(pc.field('imt'), pa.array(imts)))
-        & (pc.is_in(pc.field('nloc_001'), pa.array(nloc_001s)))
-        & (pc.field('vs30') == pc.scalar(vs30))
-        & (pc.field('hazard_model_id') == pc.scalar(hazard_id))
-    )
-    columns = ['agg', 'values', 'vs30', 'imt', 'lat', 'lon']
-    arrow_scanner = ds.Scanner.from_dataset(dataset, filter=flt, columns=columns)
-    table = arrow_scanner.to_table()
-    hazard_curves = table.to_pandas()
-    hazard_curves[['lat', 'lon']] = hazard_curves[['lat', 'lon']].applymap(lambda x: '{0:.3f}'.format(x))
-    hazard_curves['level'] = pd.NA
-    hazard_curves['level'] = hazard_curves['level'].apply(lambda x: imtls)
-    hazard_curves.rename({'values': 'apoe'}, axis='columns', inplace=True)
-
-    return hazard_curves
\ No newline at end of file
+    if cache is not None:
+        hazard_curves = cache.get_curves(hazard_id, vs30, nloc_001s, imts, aggs, fetch, source=dataset_source(fs_specs))
+        hazard_curves['vs30'] = vs30
+        return hazard_curves
+    return fetch(nloc_001s, imts, aggs)
@@ -1,4 +1,5 @@
 from pathlib import Path
+from typing import Optional
 import time
 
 import pandas as pd
@@ -8,8 +9,9 @@ import numpy as np
 from nzshm_common.location import CodedLocation
 from nzshm_common.grids import RegionGrid
 
-from nzshm_hazlab.store.curves import get_hazard_v1, get_hazard
-from nzshm_hazlab.data_functions import get_poe_df, compute_hazard_at_poe
+from nzshm_hazlab.store.curves import get_hazard_v1, get_hazard, iter_hazard_batches
+from nzshm_hazlab.store.cache import CurveCache
+from nzshm_hazlab.data_functions import get_poe_df, compute_hazard_at_poe, compute_hazard_at_poes
 from toshi_hazard_store import query
 
 
@@ -25,18 +27,34 @@ def grid_locations(site_list):
         yield CodedLocation(loc[0], loc[1], RESOLUTION)
 
 
-# def poe_archive_filepath(hazard_id, imt, agg, poe, vs30):
+def get_hazard_at_poe_from_curves(hazard_id, vs30, imt, agg, poe, locations=None, batch_size=1000):
+    """
+    hazard at poe for each location, computed from the hazard curves streamed in batches so that only
+    one batch of curves is held in memory. Defaults to the SITE_LIST grid.
+    """
 
-#     file_name = f'{hazard_id}-{imt}-{agg}-{poe}-{vs30}.bz2'
-#     return Path(ARCHIVE_DIR, file_name)
+    locations = locations if locations is not None else list(grid_locations(SITE_LIST))
+    lat = []
+    lon = []
+    level = []
+    for batch in iter_hazard_batches(hazard_id, vs30, locations, [imt], [agg], batch_size=batch_size):
+        lat_lon = pd.Series(batch.locations).str.split('~', expand=True).astype(float)
+        lat.append(lat_lon[0].to_numpy())
+        lon.append(lat_lon[1].to_numpy())
+        level.append(compute_hazard_at_poes(batch.levels, batch.apoe, [poe], INV_TIME)[:, 0])
 
+    if not level:
+        return pd.DataFrame(columns=['lat', 'lon', 'level'], dtype='float64')
+    return pd.DataFrame(data={'lat': np.concatenate(lat), 'lon': np.concatenate(lon), 'level': np.concatenate(level)})
 
-# def save_hazard_poe(haz_poe: DataFrame, hazard_id, imt, agg, poe, vs30):
 
-#     haz_poe.to_json(poe_archive_filepath(hazard_id, imt, agg, poe, vs30))
+def get_hazard_at_poe(hazard_id, vs30, imt, agg, poe, cache: Optional[CurveCache] = None):
 
-    
-def get_hazard_at_poe(hazard_id, vs30, imt, agg, poe):
+    key = ('poe_grid', SITE_LIST, vs30, imt, agg, poe)
+    if cache is not None:
+        haz_poe = cache.read_frame(hazard_id, key)
+        if haz_poe is not None:
+            return haz_poe
 
     ghaz = next(query.get_gridded_hazard([hazard_id], [SITE_LIST], [vs30], [imt], [agg], [poe]))
     grid = RegionGrid[SITE_LIST]
@@ -46,6 +64,8 @@ def get_hazard_at_poe(hazard_id, vs30, imt, agg, poe):
     lat = [loc.lat for loc in locations]
     lon = [loc.lon for loc in locations]
     haz_poe = pd.DataFrame( data={'lat': lat, 'lon': lon, 'level': ghaz.grid_poes})
+    if cache is not None:
+        cache.write_frame(hazard_id, key, haz_poe)
     return haz_poe
 
     # fp = poe_archive_filepath(hazard_id, imt, agg, poe, vs30)
@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+
+from nzshm_hazlab.store.cache import CurveCache
+
+NLEVELS = 4
+IN_STORE = ['-41.300~174.780', '-36.870~174.770', '-43.530~172.630', '-45.870~170.500']
+NOT_IN_STORE = '-50.000~170.000'
+
+
+class CountingFetch:
+
+    def __init__(self):
+        self.requests = []
+
+    def __call__(self, loc_strs, imts, aggs):
+        self.requests.append((list(loc_strs), list(imts), list(aggs)))
+        rows = [(loc, imt, agg) for loc in loc_strs for imt in imts for agg in aggs if loc in IN_STORE]
+        return pd.DataFrame({
+            'lat': [loc.split('~')[0] for loc, _, _ in rows],
+            'lon': [loc.split('~')[1] for loc, _, _ in rows],
+            'imt': [imt for _, imt, _ in rows],
+            'agg': [agg for _, _, agg in rows],
+            'level': [np.logspace(-2, 0, NLEVELS) for _ in rows],
+            'apoe': [np.full(NLEVELS, IN_STORE.index(loc) + 1.0) for loc, _, _ in rows],
+        }, columns=['lat', 'lon', 'imt', 'agg', 'level', 'apoe'])
+
+    def keys(self):
+        return [(loc, imt, agg) for locs, imts, aggs in self.requests for loc in locs for imt in imts for agg in aggs]
+
+
+def test_only_missing_curves_are_fetched(tmp_path):
+    cache = CurveCache(tmp_path)
+    fetch = CountingFetch()
+
+    cache.get_curves('hazard_id', 400, IN_STORE[:3], ['PGA'], ['mean'], fetch)
+    fetch.requests.clear()
+
+    curves = cache.get_curves('hazard_id', 400, IN_STORE, ['PGA'], ['mean', '0.1'], fetch)
+
+    fetched = fetch.keys()
+    assert len(fetched) == len(set(fetched))
+    assert set(fetched) == {(IN_STORE[3], 'PGA', 'mean')} | {(loc, 'PGA', '0.1') for loc in IN_STORE}
+    assert len(curves) == 8
+
+
+def test_locations_absent_from_store_are_not_requested_again(tmp_path):
+    cache = CurveCache(tmp_path)
+    fetch = CountingFetch()
+
+    curves = cache.get_curves('hazard_id', 400, [NOT_IN_STORE], ['PGA'], ['mean'], fetch)
+    assert len(curves) == 0
+    curves = cache.get_curves('hazard_id', 400, [NOT_IN_STORE], ['PGA'], ['mean'], fetch)
+    assert len(curves) == 0
+    assert len(fetch.requests) == 1
+
+    # the placeholder does not get in the way of curves fetched later
+    curves = cache.get_curves('hazard_id', 400, [NOT_IN_STORE, IN_STORE[0]], ['PGA'], ['mean'], fetch)
+    assert fetch.requests[-1] == ([IN_STORE[0]], ['PGA'], ['mean'])
+    assert len(curves) == 1
+    assert np.array_equal(curves['apoe'][0], np.full(NLEVELS, 1.0))
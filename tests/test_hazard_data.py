@@ -0,0 +1,61 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+import nzshm_hazlab.hazard_data as hazard_data
+from nzshm_hazlab.hazard_data import LazyData
+
+IMTS = ['PGA', 'SA(1.0)']
+NRLZ = 10
+NLEVELS = 20
+
+
+class CountingQuery:
+
+    def __init__(self):
+        self.calls = 0
+
+    def get_hazard_rlz_curves_v2(self, hazard_id, imts, locs, rlzs):
+        self.calls += 1
+        for loc in locs:
+            for rlz in range(NRLZ):
+                values = [
+                    SimpleNamespace(imt=imt, lvls=list(np.logspace(-3, 1, NLEVELS)), vals=list(np.full(NLEVELS, rlz)))
+                    for imt in (imts or IMTS)
+                ]
+                yield SimpleNamespace(loc=loc, rlz=str(rlz), values=values)
+
+
+@pytest.fixture
+def counting_query(monkeypatch):
+    counting_query = CountingQuery()
+    monkeypatch.setattr(hazard_data, 'query', counting_query)
+    return counting_query
+
+
+def read_location(data, location):
+    for imt in IMTS:
+        for rlz in range(NRLZ):
+            assert data[(imt, location, rlz)].vals[0] == rlz
+
+
+def test_one_query_per_location_under_tight_bound(counting_query):
+    location_bytes = len(IMTS) * NRLZ * NLEVELS * 8
+    data = LazyData('hazard_id', max_bytes=location_bytes)
+
+    read_location(data, 'A')
+    assert counting_query.calls == 1
+    read_location(data, 'B')
+    assert counting_query.calls == 2
+    assert data.cache_info().nbytes <= location_bytes
+
+
+def test_bound_below_one_location_warns_and_does_not_thrash(counting_query):
+    location_bytes = len(IMTS) * NRLZ * NLEVELS * 8
+    data = LazyData('hazard_id', max_bytes=location_bytes // 3)
+
+    with pytest.warns(UserWarning):
+        read_location(data, 'A')
+    assert counting_query.calls == 1
+    assert data.cache_info().evictions == 0
@@ -0,0 +1,34 @@
+import numpy as np
+
+from nzshm_hazlab.prepare_design_intensities import find_uniform_risk_intensities, solve_risk_medians
+
+IMTL = np.logspace(-4, 1, 40)
+
+
+def hazard_curve(scale):
+    return 1e-2 * np.exp(-np.log(IMTL / scale) ** 2)
+
+
+def test_invalid_curves_return_nan():
+    hcurves = np.stack([
+        hazard_curve(0.3),
+        np.full(len(IMTL), np.nan),
+        np.zeros(len(IMTL)),
+        np.where(np.arange(len(IMTL)) == 5, np.nan, hazard_curve(0.3)),
+    ])
+
+    median = solve_risk_medians(hcurves, IMTL, 0.5, 1e-5)
+    im_r, median_r = find_uniform_risk_intensities(hcurves, IMTL, 0.5, 1e-5, 0.1)
+
+    assert np.isfinite(median[0]) and np.isfinite(im_r[0])
+    assert np.all(np.isnan(median[1:]))
+    assert np.all(np.isnan(im_r[1:]))
+    assert np.array_equal(median, median_r, equal_nan=True)
+
+
+def test_invalid_curves_do_not_change_valid_results():
+    valid = np.stack([hazard_curve(0.1), hazard_curve(0.5)])
+    mixed = np.stack([valid[0], np.full(len(IMTL), np.nan), valid[1], np.zeros(len(IMTL))])
+
+    assert np.array_equal(solve_risk_medians(valid, IMTL, 0.5, 1e-5),
+                          solve_risk_medians(mixed, IMTL, 0.5, 1e-5)[[0, 2]])